@@ -0,0 +1,256 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Microbenchmarks for the buffer, cache and queue hot paths.
+
+Usage::
+
+    python -m benchmarks.bench [-o results.json] [--compare base.json]
+
+Neither Qt nor the musicplayer core are needed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from .stubs import install_musicplayer_stub, StubApp, raw_song
+
+install_musicplayer_stub()
+
+from jfmp.data import DualPositionBytesIO, Song  # noqa: E402
+from jfmp.player import Player  # noqa: E402
+
+CHUNK_SIZE = 8192  # size of the chunks written by the api client
+PACKET_SIZE = 4096  # size of the packets read by the core
+CACHE_SIZES = [64 * 1024, 1024 ** 2, 8 * 1024 ** 2, 32 * 1024 ** 2]
+QUEUE_SIZES = [1000, 10000, 100000]
+
+
+def measure(func, repeat=5, number=1):
+    """Runs ``func`` ``number`` times per sample and returns the sorted
+    per-call durations of ``repeat`` samples, in seconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return sorted(samples)
+
+
+def result(samples, unit='s', **extra):
+    """Formats a list of samples as a result entry."""
+    entry = {
+        'unit': unit,
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'max': samples[-1],
+        'samples': len(samples),
+    }
+    entry.update(extra)
+    return entry
+
+
+def bench_buffer_concurrent(size=32 * 1024 ** 2, repeat=5):
+    """Throughput of a writer and a reader thread sharing a buffer."""
+    chunk = os.urandom(CHUNK_SIZE)
+    samples = []
+    empty_reads = []
+    for _ in range(repeat):
+        buff = DualPositionBytesIO()
+        misses = 0
+
+        def writer():
+            for _ in range(size // CHUNK_SIZE):
+                buff.write(chunk)
+            buff.finish()
+
+        thread = threading.Thread(target=writer)
+        start = time.perf_counter()
+        thread.start()
+        read = 0
+        while read < size:
+            packet = buff.read(PACKET_SIZE)
+            if not packet:
+                # The reader caught up with the writer.
+                misses += 1
+                time.sleep(0)
+            read += len(packet)
+        thread.join()
+        elapsed = time.perf_counter() - start
+        samples.append(size / elapsed / 1024 ** 2)
+        empty_reads.append(misses)
+    entry = result(sorted(samples), unit='MiB/s', bytes=size)
+    entry['empty_reads'] = statistics.median(empty_reads)
+    return {'buffer.concurrent_rw': entry}
+
+
+def bench_cache(app, repeat=5):
+    """Latency of ``Song.write_to_cache`` and ``Song.read_from_cache``."""
+    results = {}
+    for size in CACHE_SIZES:
+        data = os.urandom(size)
+        song = Song(raw_song(size, 'Cache'), app)
+
+        def write():
+            song.buff = DualPositionBytesIO(data)
+            song.write_to_cache()
+
+        def read():
+            song.buff = DualPositionBytesIO()
+            song.read_from_cache()
+
+        results[f'cache.write.{size}'] = result(
+            measure(write, repeat), bytes=size)
+        results[f'cache.read.{size}'] = result(
+            measure(read, repeat), bytes=size)
+        os.remove(song.url)
+    return results
+
+
+def buffered_song(raw, app) -> Song:
+    """Returns a song already buffered, so that playing or peeking it
+    starts no download."""
+    song = Song(raw, app)
+    song.buff = DualPositionBytesIO()
+    song.buff.finish()
+    return song
+
+
+def bench_queue(app, repeat=5):
+    """Cost of the queue operations for various queue lengths."""
+    results = {}
+    album = [raw_song(i, 'Added') for i in range(12)]
+    for length in QUEUE_SIZES:
+        player = Player(app)
+        songs = [buffered_song(raw_song(i), app) for i in range(length)]
+        player.songs = list(songs)
+        player.curr_song = length // 2
+        queue = player.get_songs()
+
+        def add():
+            player.songs = list(songs)
+            player.add_to_queue([Song(r, app) for r in album])
+
+        def play_queue_song():
+            player.play_queue_song(length // 2)
+
+        results[f'queue.peek.{length}'] = result(
+            measure(lambda: player.peek_songs(10), repeat, 10),
+            length=length)
+        results[f'queue.next.{length}'] = result(
+            measure(lambda: next(queue), repeat, 100), length=length)
+        results[f'queue.add.{length}'] = result(
+            measure(add, repeat), length=length)
+        results[f'queue.play_song.{length}'] = result(
+            measure(play_queue_song, repeat, 10), length=length)
+    return results
+
+
+def bench_song(app, repeat=5, number=10000):
+    """Cost of constructing a ``Song``."""
+    raws = [raw_song(i) for i in range(number)]
+
+    def construct():
+        for raw in raws:
+            Song(raw, app)
+
+    samples = [s / number for s in measure(construct, repeat)]
+    return {'song.construct': result(samples)}
+
+
+BENCHMARKS = {
+    'buffer': lambda app, repeat: bench_buffer_concurrent(repeat=repeat),
+    'cache': bench_cache,
+    'queue': bench_queue,
+    'song': bench_song,
+}
+
+
+def git_revision():
+    """Returns the current commit of the repository, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base: dict, current: dict):
+    """Prints the median change of each benchmark between two runs."""
+    for name, entry in sorted(current['results'].items()):
+        old = base['results'].get(name)
+        if old is None:
+            print(f'{name:32} {entry["median"]:12.6g} {entry["unit"]:6} new')
+            continue
+        change = (entry['median'] - old['median']) / old['median'] * 100
+        print(f'{name:32} {entry["median"]:12.6g} {entry["unit"]:6} '
+              f'{change:+7.1f}%')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-o', '--output', help='write the results to this JSON file')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='number of samples per benchmark (default: 5)')
+    parser.add_argument(
+        '-c', '--compare', metavar='BASE',
+        help='print the changes compared to a previous results file')
+    parser.add_argument(
+        'only', nargs='*', metavar='NAME',
+        help=f'benchmarks to run among {", ".join(BENCHMARKS)} '
+             '(default: all)')
+    args = parser.parse_args(argv)
+    for name in args.only:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark: {name}')
+
+    app = StubApp()
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results.update(BENCHMARKS[name](app, args.repeat))
+    app.scheduler.shutdown()
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Local stand-in for a Jellyfin server.
+
+Only the endpoints used by ``jfmp.client.Client`` are implemented: the
+authentication, ``user_items``, recently added, search and audio stream
+ones. Latency, bandwidth and failures can be injected.
+
+Usage::
+
+    python -m benchmarks.fake_server [--port 8096] [--latency 0.05] ...
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+SERVER_ID = 'fa4e5a4e0000000000000000000000f5'
+USER_ID = '0123456789abcdef0123456789abcdef'
+TOKEN = 'fake-token'
+USERNAME = 'user'
+PASSWORD = 'password'
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class Library:
+    """Deterministic fake music library.
+
+    Parameters
+    ----------
+    albums : int
+        Number of albums.
+    tracks : int
+        Number of tracks per album.
+    track_size : int
+        Size in bytes of each audio stream.
+    """
+
+    def __init__(self, albums=100, tracks=12, track_size=256 * 1024):
+        self.track_size = track_size
+        self.albums = []
+        self.songs = {}
+        for a in range(albums):
+            album = {
+                'Id': f'a{a:031x}',
+                'Name': f'Album {a}',
+                'Type': 'MusicAlbum',
+            }
+            album['Songs'] = []
+            for t in range(tracks):
+                song = {
+                    'Id': f's{a:015x}{t:016x}',
+                    'Name': f'Track {t + 1}',
+                    'Album': album['Name'],
+                    'AlbumId': album['Id'],
+                    'AlbumArtist': f'Artist {a % 10}',
+                    'Type': 'Audio',
+                    'RunTimeTicks': 180 * 10 ** 7,
+                    'MediaStreams': [{
+                        'Type': 'Audio',
+                        'SampleRate': 48000 if t % 4 == 0 else 44100,
+                    }],
+                    'MediaSources': [{'Size': track_size}],
+                }
+                album['Songs'].append(song)
+                self.songs[song['Id']] = song
+            self.albums.append(album)
+
+    def album(self, album_id):
+        for album in self.albums:
+            if album['Id'] == album_id:
+                return album
+        return None
+
+    @staticmethod
+    def public(item):
+        return {k: v for k, v in item.items() if k != 'Songs'}
+
+    def audio(self, song_id):
+        """Yields the deterministic content of a song by 64KiB blocks."""
+        seed = song_id.encode()
+        block = (seed * (65536 // len(seed) + 1))[:65536]
+        pos = 0
+        while pos < self.track_size:
+            chunk = block[:self.track_size - pos]
+            yield chunk
+            pos += len(chunk)
+
+
+class FakeJellyfin:
+    """HTTP server implementing a subset of the Jellyfin api.
+
+    Parameters
+    ----------
+    library : Library, optional
+        The library to serve, by default a new ``Library()``.
+    host : str, optional
+        Interface to listen on, by default '127.0.0.1'.
+    port : int, optional
+        Port to listen on, by default a random free one.
+    latency : float, optional
+        Delay in seconds added before each response, by default 0.
+    bandwidth : int, optional
+        Maximum throughput of each audio stream in bytes per second,
+        by default unlimited.
+    failure_rate : float, optional
+        Probability that a request fails, by default 0. Api requests fail
+        with an error 503, audio streams are cut in the middle.
+    seed : int, optional
+        Seed of the failure injection.
+    """
+
+    def __init__(self, library=None, host='127.0.0.1', port=0, latency=0.,
+                 bandwidth=None, failure_rate=0., seed=None):
+        self.library = library or Library()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.requests = Counter()
+        self.failures = Counter()
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serves the api from a background thread."""
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name='fake-jellyfin',
+            daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': dict(self.requests),
+                'failures': dict(self.failures),
+                'bytes_sent': self.bytes_sent,
+            }
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+            fail = endpoint != 'socket' and \
+                self._random.random() < self.failure_rate
+            if fail:
+                self.failures[endpoint] += 1
+            return fail
+
+    def _sent(self, n):
+        with self._lock:
+            self.bytes_sent += n
+
+    def system_info(self):
+        return {
+            'ServerName': 'Fake Jellyfin',
+            'Id': SERVER_ID,
+            'Version': '10.8.0',
+            'LocalAddress': self.url,
+            'ProductName': 'Jellyfin Server',
+            'StartupWizardCompleted': True,
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'/system/info/public', 'public_info'),
+        ('GET', r'/system/info', 'system_info'),
+        ('POST', r'/users/authenticatebyname', 'authenticate'),
+        ('GET', r'/users/(?P<user>\w+)/items/latest', 'latest'),
+        ('GET', r'/users/(?P<user>\w+)/items', 'items'),
+        ('GET', r'/audio/(?P<item>\w+)/universal', 'audio'),
+        ('POST', r'/sessions/playing(/progress|/stopped)?', 'session'),
+        ('GET', r'/socket', 'socket'),
+    ]
+
+    @property
+    def fake(self) -> FakeJellyfin:
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        for verb, pattern, name in self.routes:
+            match = re.fullmatch(pattern, url.path.lower().rstrip('/'))
+            if verb == method and match:
+                break
+        else:
+            self._send_json({'error': 'not found'}, 404)
+            return
+        fail = self.fake._count(name)
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        if fail and name != 'audio':
+            self._send_json({'error': 'injected failure'}, 503)
+            return
+        getattr(self, name)(query=query, body=body, fail=fail,
+                            **match.groupdict())
+
+    def _authorized(self):
+        auth = self.headers.get('Authorization', '')
+        return f'Token="{TOKEN}"' in auth or \
+            self.headers.get('X-Emby-Token') == TOKEN
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.fake._sent(len(payload))
+
+    def public_info(self, **kwargs):
+        self._send_json(self.fake.system_info())
+
+    def system_info(self, **kwargs):
+        if not self._authorized():
+            self._send_json({'error': 'unauthorized'}, 401)
+            return
+        self._send_json(self.fake.system_info())
+
+    def authenticate(self, body, **kwargs):
+        data = json.loads(body or b'{}')
+        if data.get('username') != USERNAME or data.get('Pw') != PASSWORD:
+            self._send_json({'error': 'invalid credentials'}, 401)
+            return
+        self._send_json({
+            'User': {'Id': USER_ID, 'Name': USERNAME},
+            'AccessToken': TOKEN,
+            'ServerId': SERVER_ID,
+        })
+
+    def latest(self, query, **kwargs):
+        limit = int(query.get('Limit') or 20)
+        albums = self.fake.library.albums[::-1][:limit]
+        self._send_json([Library.public(a) for a in albums])
+
+    def items(self, query, **kwargs):
+        library = self.fake.library
+        if query.get('searchTerm') is not None:
+            term = query['searchTerm'].lower()
+            limit = int(query.get('Limit') or 20)
+            items = [Library.public(a) for a in library.albums
+                     if term in a['Name'].lower()][:limit]
+        elif query.get('ParentId') is not None:
+            album = library.album(query['ParentId'])
+            items = album['Songs'] if album is not None else []
+        else:
+            items = list(library.songs.values())
+        self._send_json({
+            'Items': items,
+            'TotalRecordCount': len(items),
+            'StartIndex': 0,
+        })
+
+    def audio(self, item, fail, **kwargs):
+        library = self.fake.library
+        if item not in library.songs:
+            self._send_json({'error': 'not found'}, 404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/ogg')
+        self.send_header('Content-Length', str(library.track_size))
+        self.end_headers()
+        cut = library.track_size // 2 if fail else None
+        bandwidth = self.fake.bandwidth
+        start = time.monotonic()
+        sent = 0
+        for chunk in library.audio(item):
+            if cut is not None and sent + len(chunk) > cut:
+                self.wfile.write(chunk[:cut - sent])
+                self.close_connection = True
+                return
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self.fake._sent(len(chunk))
+            if bandwidth:
+                ahead = sent / bandwidth - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def session(self, **kwargs):
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def socket(self, **kwargs):
+        key = self.headers.get('Sec-WebSocket-Key', '') + WEBSOCKET_GUID
+        accept = base64.b64encode(hashlib.sha1(key.encode()).digest())
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode())
+        self.end_headers()
+        self.wfile.flush()
+        # Nothing is ever pushed, keep the connection open until the client
+        # goes away so that it does not keep reconnecting.
+        while self.rfile.read(1):
+            pass
+        self.close_connection = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8096)
+    args = parser.parse_args(argv)
+    server = from_arguments(args, host=args.host, port=args.port)
+    print(f'Serving on {server.url} '
+          f'(username: {USERNAME}, password: {PASSWORD})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Adds the options of the fake server to an argument parser."""
+    parser.add_argument('--albums', type=int, default=100)
+    parser.add_argument('--tracks', type=int, default=12,
+                        help='number of tracks per album')
+    parser.add_argument('--track-size', type=int, default=256 * 1024,
+                        help='size of each track in bytes')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='delay added to each response in seconds')
+    parser.add_argument('--bandwidth', type=int,
+                        help='throughput of audio streams in bytes/s')
+    parser.add_argument('--failure-rate', type=float, default=0.,
+                        help='probability of a request to fail')
+    parser.add_argument('--seed', type=int)
+
+
+def from_arguments(args, **kwargs) -> FakeJellyfin:
+    """Creates a server from parsed arguments."""
+    library = Library(args.albums, args.tracks, args.track_size)
+    return FakeJellyfin(library, latency=args.latency,
+                        bandwidth=args.bandwidth,
+                        failure_rate=args.failure_rate,
+                        seed=args.seed, **kwargs)
+
+
+if __name__ == '__main__':
+    main()
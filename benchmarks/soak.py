@@ -0,0 +1,209 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""End-to-end soak test against a local fake Jellyfin server.
+
+Plays through thousands of tracks using the real ``Client`` and ``Player``
+with a stubbed audio core, and records memory growth, download counts and
+stalls over time.
+
+Usage::
+
+    python -m benchmarks.soak [--play 2000] [-o timeline.json] ...
+"""
+
+import argparse
+import json
+import logging
+import resource
+import sys
+import time
+
+from .stubs import install_musicplayer_stub, StubApp
+from . import fake_server
+
+CORES = install_musicplayer_stub(realtime=True)
+
+from jfmp.client import Client  # noqa: E402
+from jfmp.player import Player  # noqa: E402
+
+
+def rss():
+    """Returns the current resident set size in bytes."""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Peak RSS, in KiB on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def buffered(songs):
+    """Returns the number of live buffers and the bytes they hold."""
+    buffers = [s.buff for s in songs if s.buff is not None]
+    return len(buffers), sum(len(b._buffer) for b in buffers)
+
+
+class Soak:
+    """Headless driver playing the whole queue through ``Player``.
+
+    Parameters
+    ----------
+    server : FakeJellyfin
+        The server to play from.
+    rate : int
+        Playback speed of the stubbed core in bytes per second.
+    """
+
+    def __init__(self, server, rate):
+        self.server = server
+        self.app = StubApp()
+        self.app.client = Client(self.app)
+        self.app.player = Player(self.app)
+        self.core = CORES[-1]
+        self.core.rate = rate
+        self.changes = 0
+        self.app.player.add_event_listener('song_change', self.on_song_change)
+
+    def on_song_change(self, **kwargs):
+        self.changes += 1
+
+    def log_in(self):
+        if not self.app.client.log_in(
+                self.server.url, fake_server.USERNAME, fake_server.PASSWORD):
+            raise RuntimeError(f'could not log in to {self.server.url}')
+
+    def build_queue(self, length):
+        client = self.app.client
+        songs = []
+        for album in client.get_latest_albums():
+            songs += client.get_album_songs(album)
+            if len(songs) >= length:
+                break
+        return songs[:length]
+
+    def sample(self, start, songs):
+        buffers, held = buffered(songs)
+        stats = self.server.stats()
+        return {
+            'time': round(time.monotonic() - start, 3),
+            'played': self.changes,
+            'rss': rss(),
+            'live_buffers': buffers,
+            'buffered_bytes': held,
+            'downloads': self.app.downloads,
+            'stream_requests': stats['requests'].get('audio', 0),
+            'stream_failures': stats['failures'].get('audio', 0),
+            'stalls': self.core.underruns,
+            'errors': self.core.errors,
+        }
+
+    def run(self, play, queue_length, interval, report=None):
+        # Only inject failures once the queue is ready.
+        failure_rate = self.server.failure_rate
+        self.server.failure_rate = 0.
+        self.log_in()
+        songs = self.build_queue(queue_length)
+        if not songs:
+            raise RuntimeError('the server returned no songs')
+        self.server.failure_rate = failure_rate
+        timeline = []
+        start = time.monotonic()
+        self.app.player.play_new_queue(songs)
+        while self.changes < play:
+            time.sleep(interval)
+            timeline.append(self.sample(start, songs))
+            if report is not None:
+                report(timeline[-1])
+        self.app.player.cmd_pause()
+        self.app.client.stop()
+        self.app.scheduler.shutdown()
+        return timeline
+
+
+def summarize(timeline):
+    """Computes the growth of the measures between the first and the last
+    samples."""
+    first, last = timeline[0], timeline[-1]
+    duration = last['time'] - first['time'] or 1
+    played = max(1, last['played'] - first['played'])
+    return {
+        'duration': last['time'],
+        'played': last['played'],
+        'rss_start': first['rss'],
+        'rss_end': last['rss'],
+        'rss_growth_per_track': (last['rss'] - first['rss']) / played,
+        'live_buffers_end': last['live_buffers'],
+        'buffered_bytes_end': last['buffered_bytes'],
+        'downloads': last['downloads'],
+        'stream_requests': last['stream_requests'],
+        'stream_failures': last['stream_failures'],
+        'stalls': last['stalls'],
+        'errors': last['errors'],
+        'tracks_per_second': played / duration,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_server.add_arguments(parser)
+    parser.add_argument('--play', type=int, default=2000,
+                        help='number of tracks to play (default: 2000)')
+    parser.add_argument('--queue', type=int, default=1000,
+                        help='length of the queue (default: 1000)')
+    parser.add_argument('--rate', type=int, default=16 * 1024 ** 2,
+                        help='playback speed in bytes/s (default: 16MiB/s)')
+    parser.add_argument('--interval', type=float, default=1.,
+                        help='sampling interval in seconds (default: 1)')
+    parser.add_argument('-o', '--output',
+                        help='write the timeline to this JSON file')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    for name in ('Jellyfin', 'JELLYFIN'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    server = fake_server.from_arguments(args).start()
+
+    def report(sample):
+        print(' '.join(f'{k}={v}' for k, v in sample.items()),
+              file=sys.stderr)
+
+    try:
+        soak = Soak(server, args.rate)
+        timeline = soak.run(args.play, args.queue, args.interval,
+                            None if args.quiet else report)
+    finally:
+        server.stop()
+    result = {
+        'summary': summarize(timeline),
+        'server': server.stats(),
+        'timeline': timeline,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    json.dump(result['summary'], sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Headless stand-ins for the musicplayer core and the Qt app.
+
+Importing this module installs a fake ``musicplayer`` module so that
+``jfmp.player`` can be imported without the compiled core, and points the
+jfmp cache and config directories to a temporary location so that
+benchmarks never touch the user's real cache.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+ROOT_DIR = tempfile.mkdtemp(prefix='jfmp-bench-')
+os.environ['XDG_CACHE_HOME'] = os.path.join(ROOT_DIR, 'cache')
+os.environ['XDG_CONFIG_HOME'] = os.path.join(ROOT_DIR, 'config')
+
+
+class StubCore:
+    """Minimal imitation of the object returned by
+    ``musicplayer.createPlayer()``.
+
+    When ``realtime`` is False, ``nextSong`` only switches songs. When it is
+    True, a playback thread pulls packets from the current song through
+    ``readPacket`` at ``rate`` bytes per second, like the real core does,
+    and moves on to the next song when the current one reaches its end.
+    """
+
+    packet_size = 4096
+
+    def __init__(self, realtime=False, rate=None):
+        self.outSamplerate = 48000
+        self.queue = None
+        self.peekQueue = None
+        self.onSongChange = None
+        self.curSong = None
+        self.curSongMetadata = {}
+        self.curSongPos = 0.
+        self.curSongLen = 0.
+        self.realtime = realtime
+        self.rate = rate
+        self.underruns = 0
+        self.errors = 0
+        self._playing = False
+        self._lock = threading.Lock()
+        self._skip = threading.Event()
+        self._thread = None
+
+    @property
+    def playing(self):
+        return self._playing
+
+    @playing.setter
+    def playing(self, value):
+        self._playing = bool(value)
+        if self.realtime and self._playing and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._playback, name='stub-core', daemon=True)
+            self._thread.start()
+
+    def nextSong(self):
+        if self.realtime:
+            self._skip.set()
+        else:
+            self._switch()
+
+    def seekAbs(self, pos):
+        self.curSongPos = pos
+
+    def _switch(self):
+        with self._lock:
+            old_song = self.curSong
+            self.curSong = next(self.queue)
+            self.curSongPos = 0.
+            if self.peekQueue is not None:
+                self.peekQueue(1)
+            if self.onSongChange is not None:
+                self.onSongChange(oldSong=old_song, newSong=self.curSong)
+            return self.curSong
+
+    def _playback(self):
+        while True:
+            self._skip.clear()
+            self._play(self._switch())
+
+    def _play(self, song):
+        start = time.monotonic()
+        total = 0
+        while not self._skip.is_set():
+            if not self._playing:
+                time.sleep(0.01)
+                continue
+            wait = time.monotonic()
+            try:
+                if total == 0:
+                    song.seekRaw(0, 0)
+                packet = song.readPacket(self.packet_size)
+            except Exception:
+                # The real core logs the error and skips the song.
+                self.errors += 1
+                return
+            if time.monotonic() - wait > 0.1:
+                self.underruns += 1
+            if not packet:
+                return
+            total += len(packet)
+            if self.rate:
+                ahead = total / self.rate - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            self.curSongPos = time.monotonic() - start
+
+
+def install_musicplayer_stub(**core_kwargs):
+    """Makes the fake ``musicplayer`` module create cores with the given
+    arguments.
+
+    Returns the list that collects every core created through it.
+    """
+    cores = []
+
+    def create_player():
+        core = StubCore(**core_kwargs)
+        cores.append(core)
+        return core
+
+    MUSICPLAYER.createPlayer = create_player
+    return cores
+
+
+MUSICPLAYER = types.ModuleType('musicplayer')
+MUSICPLAYER.setFfmpegLogLevel = lambda level: None
+sys.modules['musicplayer'] = MUSICPLAYER
+install_musicplayer_stub()
+
+from jfmp.interfaces import AppInterface  # noqa: E402
+from jfmp.scheduler import Scheduler  # noqa: E402
+
+
+class StubApp(AppInterface):
+    """Qt-free app, downloading the songs like ``App`` does.
+
+    Only the methods that need the GUI are stubbed.
+    """
+
+    def __init__(self, client=None):
+        super().__init__()
+        self.scheduler = Scheduler()
+        self.client = client
+        self.player = None
+        self.sync = None
+        self.downloads = 0
+
+    def play_songs(self, songs):
+        self.player.play_new_queue(songs)
+
+    def add_to_queue(self, songs):
+        self.player.add_to_queue(songs)
+
+    def download_stream(self, song, prefetch=False):
+        self.downloads += 1
+        super().download_stream(song, prefetch)
+
+
+def raw_song(i: int, album: str = 'Album') -> dict:
+    """Returns a minimal api item for the song number ``i``."""
+    return {
+        'Id': f'{i:032x}',
+        'Name': f'Song {i}',
+        'Album': album,
+        'AlbumArtist': 'Artist',
+    }
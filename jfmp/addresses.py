@@ -0,0 +1,183 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from .file import conf_file
+
+ADDRESSES_LOCATION = conf_file('addresses.json')
+ADDRESS_KEYS = ('address', 'ManualAddress', 'LocalAddress', 'RemoteAddress')
+
+LOG = logging.getLogger(__name__)
+
+
+def local_ip(address: str) -> Optional[str]:
+    """Returns the local IP used to reach an address, without sending any
+    packet."""
+    url = urlsplit(address)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect((url.hostname, url.port or 80))
+            return probe.getsockname()[0]
+    except OSError:
+        return None
+
+
+class AddressSelector:
+    """Routes the client to the fastest reachable address of its server.
+
+    The addresses of the server (manual, local and remote ones) are
+    gathered from the credentials and from the server's public info, and
+    saved. They are probed in parallel, at startup, when the local IP
+    changes, and when a request fails, and the one that answers first
+    becomes the base URL of every request.
+
+    Parameters
+    ----------
+    client : Client
+        The client to route.
+    interval : float, optional
+        Delay in seconds between two checks of the local IP, by default 30.
+    timeout : float, optional
+        Timeout in seconds of a probe, by default 3.
+    """
+
+    def __init__(self, client, interval=30., timeout=3.):
+        self.client = client
+        self.interval = interval
+        self.timeout = timeout
+        self.server_id = None
+        self._lock = Lock()
+        self._addresses = []
+        self._local_ip = None
+        self._stop = Event()
+        self._thread = None
+
+    @property
+    def current(self) -> Optional[str]:
+        """The address currently used by the client."""
+        return self.client.config.data.get('auth.server')
+
+    def load(self, server: dict):
+        """Loads the known addresses of a server from its credentials."""
+        with self._lock:
+            self.server_id = server.get('Id')
+            self._addresses = self._load().get(self.server_id, [])
+        self._add([server.get(k) for k in ADDRESS_KEYS])
+
+    def addresses(self) -> List[str]:
+        with self._lock:
+            return list(self._addresses)
+
+    def probe(self) -> Optional[str]:
+        """Probes every known address in parallel and returns the fastest
+        reachable one, or None."""
+        addresses = self.addresses()
+        if not addresses:
+            return None
+        with ThreadPoolExecutor(len(addresses)) as executor:
+            results = list(executor.map(self._probe, addresses))
+        reachable = [r for r in results if r is not None]
+        for _, _, info in reachable:
+            self._add([info.get('LocalAddress')])
+        if not reachable:
+            LOG.warning('no reachable address among %s', addresses)
+            return None
+        latency, address, _ = min(reachable)
+        LOG.info('fastest address: %s (%d ms)', address, latency * 1000)
+        return address
+
+    def select(self) -> bool:
+        """Routes the client to the fastest reachable address.
+
+        Returns
+        -------
+        bool
+            False if no address is reachable.
+        """
+        address = self.probe()
+        if address is None:
+            return False
+        if address != self.current:
+            LOG.info('switching to %s', address)
+            self.client.config.data['auth.server'] = address
+        self._local_ip = local_ip(address)
+        return True
+
+    def start(self):
+        """Starts watching for network changes in the background."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._local_ip = local_ip(self.current or '')
+        self._thread = Thread(target=self._watch, name='addresses',
+                              daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            ip = local_ip(self.current or '')
+            if ip != self._local_ip:
+                LOG.info('local IP changed from %s to %s',
+                         self._local_ip, ip)
+                self.select()
+
+    def _probe(self, address: str):
+        start = time.monotonic()
+        try:
+            response = requests.get(
+                f'{address}/System/Info/Public', timeout=self.timeout)
+            response.raise_for_status()
+            info = response.json()
+        except (requests.RequestException, ValueError):
+            return None
+        if self.server_id is not None and info.get('Id') != self.server_id:
+            LOG.warning('%s is another server', address)
+            return None
+        return time.monotonic() - start, address, info
+
+    def _add(self, addresses: List[str]):
+        with self._lock:
+            new = [a.rstrip('/') for a in addresses
+                   if a and a.rstrip('/') not in self._addresses]
+            if not new or self.server_id is None:
+                return
+            self._addresses += list(dict.fromkeys(new))
+            saved = self._load()
+            saved[self.server_id] = self._addresses
+            with open(ADDRESSES_LOCATION, 'w') as file:
+                json.dump(saved, file)
+
+    def _load(self) -> dict:
+        if os.path.exists(ADDRESSES_LOCATION):
+            with open(ADDRESSES_LOCATION) as file:
+                return json.load(file)
+        return {}
@@ -15,62 +15,182 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
+import os
+import socket
+from threading import Thread
 from typing import List
 
 from PySide2.QtWidgets import QApplication
-from PySide2.QtCore import Slot, QRunnable, QThreadPool
 
 from .client import Client
-from .data import Song
+from .constants import COMMAND_NAME, CLIENT_NAME
+from .data import Song, Album, STREAM_THRESHOLD
+from .file import runtime_file
 from .interfaces import AppInterface
-from .player import Player
+from .options import add_player_arguments, add_profiling_arguments, \
+    add_sync_arguments, SYNC_WORKERS
+from .player import Player, SAMPLERATE_COMMON
+from .profiling import Profiler, install_toggle
+from .remote import RemoteClient, RemotePlayer, RemoteSync
+from .reporting import PlaybackReporter
+from .rpc import SOCKET_LOCATION, RpcConnection
+from .scheduler import Scheduler, Limit, INTERACTIVE, SYNC, checkpoint
+from .session import SessionStore
+from .sync import OfflineSync
 from .gui import PlayerWindow, LoginDialog
 
 
-def main():
+def main(argv=None):
     """Main program."""
-    app = App()
-    app.run()
+    parser = argparse.ArgumentParser(prog=COMMAND_NAME, description=CLIENT_NAME)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--attach', nargs='?', const=SOCKET_LOCATION, metavar='SOCKET',
+        help='control a running jfmp-daemon instead of playing locally '
+             f'(default socket: {SOCKET_LOCATION})')
+    mode.add_argument(
+        '--isolate', action='store_true',
+        help='play in a separate process, isolated from the GUI')
+    add_player_arguments(parser)
+    add_sync_arguments(parser)
+    add_profiling_arguments(parser)
+    args = parser.parse_args(argv)
+    if (args.attach or args.isolate) and not hasattr(socket, 'AF_UNIX'):
+        parser.error('--attach and --isolate need Unix sockets, which are '
+                     'not available on this platform')
+    profiler = Profiler(args.profile_interval / 1000, args.profile_memory,
+                        main_label='gui')
+    if args.profile:
+        profiler.start()
+    if args.isolate:
+        # The daemon module needs Unix sockets, even to be imported.
+        from .daemon import spawn
+        socket_path = runtime_file(f'engine-{os.getpid()}.sock')
+        engine_args = ['--samplerate', str(args.samplerate),
+                       '--stream-threshold', str(args.stream_threshold >> 20),
+                       '--sync-workers', str(args.sync_workers)]
+        if not args.cache:
+            engine_args.append('--no-cache')
+        engine_args += ['--profile-interval', str(args.profile_interval),
+                        '--profile-memory', str(args.profile_memory)]
+        if args.profile:
+            engine_args.append('--profile')
+        if args.sync_bandwidth:
+            engine_args += ['--sync-bandwidth',
+                            str(args.sync_bandwidth // 1024)]
+        engine = spawn(socket_path, *engine_args)
+        try:
+            App(socket_path, profiler=profiler).run()
+        finally:
+            engine.terminate()
+            engine.wait()
+    else:
+        app = App(args.attach, args.sync_workers, args.sync_bandwidth,
+                  args.samplerate, args.cache, args.stream_threshold,
+                  profiler)
+        app.run()
 
 
 class App(AppInterface):
     """App class
 
     Main object that contains everything else.
+
+    Parameters
+    ----------
+    attach : str, optional
+        Path to the socket of a daemon to use as a thin client, by default
+        None to play locally.
+    sync_workers : int, optional
+        Maximum number of parallel offline sync downloads.
+    sync_bandwidth : int, optional
+        Offline sync bandwidth cap in bytes per second, by default None for
+        unlimited.
+    samplerate : int or str, optional
+        Output sample rate or policy, see ``Player``.
+    cache : bool, optional
+        Whether the streamed songs are cached, by default True.
+    stream_threshold : int, optional
+        Size in bytes above which songs are streamed in constant memory.
+    profiler : Profiler, optional
+        The profiler toggled by SIGUSR1 and Ctrl+Shift+P, by default one
+        with the default settings.
     """
 
-    def __init__(self):
+    def __init__(self, attach=None, sync_workers=SYNC_WORKERS,
+                 sync_bandwidth=None, samplerate=SAMPLERATE_COMMON,
+                 cache=True, stream_threshold=STREAM_THRESHOLD,
+                 profiler: Profiler = None):
         super().__init__()
-        self.player = Player(self, 96000)
-        self.client = Client(self)
-        self._threadpool = QThreadPool()
+        self.cache = cache
+        self.stream_threshold = stream_threshold
+        self.profiler = profiler or Profiler(main_label='gui')
+        self.scheduler = Scheduler(
+            {SYNC: Limit(sync_workers, sync_bandwidth)})
+        if attach is None:
+            self.player = Player(self, samplerate)
+            self.client = Client(self)
+            self.reporter = PlaybackReporter(self.client, self.player)
+            self.sync = OfflineSync(self.client, self.scheduler)
+            self.session = SessionStore(self.player)
+            self.session.restore()
+        else:
+            connection = RpcConnection(attach)
+            self.player = RemotePlayer(self, connection)
+            self.client = RemoteClient(self, connection)
+            self.reporter = None
+            self.sync = RemoteSync(connection, self.player)
+            self.session = None
         self.main = None
+        self._search = None
 
     def run(self):
         """Runs the app"""
         # Qt GUI
         app = QApplication([])
         self.main = PlayerWindow(self)
+        self.main.add_to_queue(self.player.songs)
 
         if not self.client.connect():
             dialog = LoginDialog(self, self.main)
             dialog.show()
         else:
             self.display_latest_albums()
+            self.sync.resume()
 
         self.main.show()
+        install_toggle(self.profiler)
+        if self.reporter is not None:
+            self.reporter.start()
+        if self.session is not None:
+            self.session.start()
 
         # Run the main Qt loop
         app.exec_()
+        self.sync.stop()
+        self.scheduler.shutdown()
+        if self.session is not None:
+            self.session.stop()
+        if self.reporter is not None:
+            self.reporter.stop()
         self.client.stop()
+        self.profiler.stop()
+
+    def toggle_profiling(self) -> bool:
+        """Starts or stops profiling, returns whether it is starting."""
+        starting = not self.profiler.running
+        # Stopping writes the reports, which must not block the GUI.
+        Thread(target=self.profiler.toggle, name='profiler-toggle').start()
+        return starting
 
     def display_latest_albums(self):
         """Fetches then displays latests albums inside the GUI."""
         def display_latest_albums():
-            self.main.display_albums(self.client.get_latest_albums())
+            albums = self.client.get_latest_albums()
+            self.main.bus.post(self.main.display_albums, albums=albums)
         if self.client.logged_in:
-            worker = Worker(display_latest_albums)
-            self._threadpool.start(worker)
+            self.scheduler.submit(INTERACTIVE, display_latest_albums)
 
     def play_songs(self, songs: List[Song]):
         """Replaces the queue with the given list of songs and start playing.
@@ -85,48 +205,21 @@ class App(AppInterface):
 
     def add_to_queue(self, songs: List[Song]):
         self.player.add_to_queue(songs)
-        self.main.add_to_queue(songs)
 
-    def download_stream(self, song: Song):
-        """Fills the buffer of a given song."""
-        if not song.read_from_cache():
-            self.client.get_audio_stream(song)
-            song.write_to_cache()
+    def make_available_offline(self, album: Album):
+        """Downloads all the songs of an album into the cache."""
+        self.scheduler.submit(INTERACTIVE, self.sync.pin_album, album)
 
     def search(self, term):
         if (len(term) == 0):
             return
-        worker = Worker(
-            lambda: self.main.display_albums(self.client.search_albums(term)))
-        self._threadpool.start(worker)
-
-
-class Worker(QRunnable):
-    """Worker thread
-
-    Inherits from QRunnable to handler worker thread setup, signals and wrap-up.
 
-    Parameters
-    ----------
-    func : function
-        The function callback to run on this worker thread.
-        Supplied args and kwargs will be passed through to the runner.
-
-    args :
-        Arguments to pass to the callback function.
-
-    kwargs :
-        Keywords to pass to the callback function.
-    """
-
-    def __init__(self, func, *args, **kwargs):
-        super(Worker, self).__init__()
-        # Store constructor arguments (re-used for processing)
-        self.func = func
-        self.args = args
-        self.kwargs = kwargs
-
-    @Slot()
-    def run(self):
-        """Initialises the runner function with passed args, kwargs."""
-        self.func(*self.args, **self.kwargs)
+        def search():
+            albums = self.client.search_albums(term)
+            # Raises Cancelled if a newer search started meanwhile.
+            checkpoint()
+            self.main.bus.post(self.main.display_albums, albums=albums)
+        if self._search is not None:
+            # Results of the previous terms are not needed anymore.
+            self._search.cancel()
+        self._search = self.scheduler.submit(INTERACTIVE, search)
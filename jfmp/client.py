@@ -17,17 +17,27 @@
 
 import socket
 import json
+import logging
 import os
 from typing import List
 
+import requests
 from jellyfin_apiclient_python.client import JellyfinClient
 from jellyfin_apiclient_python.connection_manager import CONNECTION_STATE
+from jellyfin_apiclient_python.exceptions import HTTPException
 
+from .addresses import AddressSelector
 from .file import conf_file
+from .scheduler import checkpoint
 from .constants import CLIENT_NAME, CLIENT_VERSION, COMMAND_NAME
 from .data import Song, Album
 
 CREDENTIALS_LOCATION = conf_file('cred.json')
+AUDIO_CONTAINERS = 'opus,mp3|mp3,aac,m4a|aac,flac,webma,webm,wav'
+# Request errors after which another address may succeed.
+STREAM_FAILURES = ('ServerUnreachable', 'ReadTimeout', 502, 503, 504)
+
+LOG = logging.getLogger(__name__)
 
 
 def ensure_logged_in():
@@ -42,6 +52,27 @@ def ensure_logged_in():
     return decorator
 
 
+def failover():
+    """Retries an api call once on the fastest reachable address, when the
+    current one fails."""
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            try:
+                return func(self, *args, **kwargs)
+            except (HTTPException, requests.RequestException) as error:
+                if isinstance(error, HTTPException) and \
+                        error.status not in STREAM_FAILURES:
+                    raise
+                if not self.addresses.select():
+                    raise
+                LOG.info('retrying %s on %s: %s', func.__name__,
+                         self.addresses.current, error)
+                return func(self, *args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
 class Client(JellyfinClient):
     """JellyfinClient extension with higher level calls."""
 
@@ -56,20 +87,35 @@ class Client(JellyfinClient):
             f'{COMMAND_NAME}@{socket.gethostname()}')
         self.config.data['http.user_agent'] = f'{COMMAND_NAME}/{CLIENT_VERSION}'
         self.config.data['auth.ssl'] = True
+        self.addresses = AddressSelector(self)
 
     def connect(self) -> bool:
-        """Try to connect using the current credentials."""
+        """Try to connect using the current credentials.
+
+        The fastest reachable address of the server is used.
+        """
         credentials = self._load_credentials()
         if credentials is None:
             return False
+        if credentials.get('Servers'):
+            server = credentials['Servers'][0]
+            self.addresses.load(server)
+            address = self.addresses.probe()
+            if address is not None:
+                server['address'] = address
         state = self.authenticate(credentials)
         if state['State'] != CONNECTION_STATE['SignedIn']:
             return False
         # self.callback = event
         # self.callback_ws = event
         self.start(websocket=True)
+        self.addresses.start()
         return True
 
+    def stop(self):
+        self.addresses.stop()
+        super().stop()
+
     def log_in(self, host: str, username: str, password: str) -> bool:
         """Try to connect using the user informations.
 
@@ -108,6 +154,7 @@ class Client(JellyfinClient):
         return None
 
     # @ensure_logged_in()
+    @failover()
     def get_latest_albums(self) -> List[Album]:
         """Fetches latests albums from the api."""
         return [Album(a) for a in self.jellyfin.get_recently_added(
@@ -115,23 +162,160 @@ class Client(JellyfinClient):
             limit=100
         )]
 
+    @failover()
     def get_album_songs(self, album: Album) -> List[Song]:
         """Fetches a given album's songs from the api."""
         response = self.jellyfin.user_items(params={
             'ParentId': album.get_id(),
             'IncludeItemTypes': 'Audio',
+            'Fields': 'MediaStreams,MediaSources',
             'SortBy': 'SortName',
         })
         return [Song(i, self.app) for i in response['Items']]
 
+    @failover()
+    def get_artist_songs(self, artist_id: str) -> List[Song]:
+        """Fetches all the songs of a given artist from the api."""
+        response = self.jellyfin.user_items(params={
+            'ArtistIds': artist_id,
+            'IncludeItemTypes': 'Audio',
+            'Fields': 'MediaStreams,MediaSources',
+            'Recursive': True,
+            'SortBy': 'Album,SortName',
+        })
+        return [Song(i, self.app) for i in response['Items']]
+
+    @failover()
+    def get_playlist_songs(self, playlist_id: str) -> List[Song]:
+        """Fetches a given playlist's songs from the api."""
+        response = self.jellyfin.user_items(params={
+            'ParentId': playlist_id,
+            'IncludeItemTypes': 'Audio',
+            'Fields': 'MediaStreams,MediaSources',
+        })
+        return [Song(i, self.app) for i in response['Items']]
+
     def get_audio_stream(self, song: Song):
         """Downloads the audio stream for a file."""
-        self.jellyfin.get_audio_stream(
-            song.get_input(),
-            song.get_id(),
-            'test',
-            'opus,mp3|mp3,aac,m4a|aac,flac,webma,webm,wav')
+        self.download_audio(song.get_id(), song.get_input())
+
+    def download_audio(self, item_id: str, dest_file, retries=3):
+        """Writes the audio stream of an item to a file object.
 
+        If the stream fails midway, the fastest reachable address is
+        selected again and the stream is requested anew, skipping the bytes
+        that were already written, so that the reader does not notice.
+
+        Every chunk is a checkpoint of the scheduler task running the
+        download, if any. The body of an error response is never written,
+        an HTTPException is raised instead.
+        """
+        writer = _ResumingWriter(dest_file)
+        while True:
+            try:
+                self.http.request({
+                    'type': 'GET',
+                    'handler': f'Audio/{item_id}/universal',
+                    'params': {
+                        'UserId': '{UserId}',
+                        'DeviceId': '{DeviceId}',
+                        'PlaySessionId': 'test',
+                        'Container': AUDIO_CONTAINERS,
+                        'MaxStreamingBitrate': 140000000,
+                    },
+                }, session=_HookedSession(
+                    self.http.session or requests, writer.check),
+                    dest_file=writer)
+                writer.raise_for_status()
+                return
+            except (HTTPException, requests.RequestException) as error:
+                if isinstance(error, HTTPException) and \
+                        error.status not in STREAM_FAILURES:
+                    raise
+                if not retries or not self.addresses.select():
+                    raise
+                LOG.info('resuming stream of %s at byte %d from %s: %s',
+                         item_id, writer.written, self.addresses.current,
+                         error)
+                retries -= 1
+                writer.restart()
+
+    @failover()
+    def report_playback(self, event: str, data: dict):
+        """Reports the playback state of an item to the server.
+
+        Parameters
+        ----------
+        event : str
+            Either 'start', 'progress' or 'stop'.
+        data : dict
+            The playback informations.
+        """
+        if event == 'start':
+            self.jellyfin.session_playing(data)
+        elif event == 'progress':
+            self.jellyfin.session_progress(data)
+        elif event == 'stop':
+            self.jellyfin.session_stop(data)
+        else:
+            raise ValueError(f'unknown playback event: {event}')
+
+    @failover()
     def search_albums(self, text):
         response = self.jellyfin.search_media_items(text, media='MusicAlbum')
         return [Album(a) for a in response['Items']]
+
+
+class _HookedSession:
+    """Requests session calling a hook on every response, before its body
+    is read."""
+
+    def __init__(self, session, hook):
+        self.session = session
+        self.hook = hook
+
+    def get(self, **kwargs):
+        return self.session.get(hooks={'response': self.hook}, **kwargs)
+
+
+class _ResumingWriter:
+    """Writes a stream that can be restarted from the beginning, skipping
+    the bytes that were already written."""
+
+    def __init__(self, file):
+        self.file = file
+        self.written = 0
+        self.status = None
+        self._skip = 0
+
+    def restart(self):
+        self._skip = self.written
+
+    # pylint: disable=unused-argument
+    def check(self, response, *args, **kwargs):
+        """Records the status of a response before its body is written, as
+        the http layer writes the body of error responses and only logs
+        some of them, such as HTTP 500."""
+        self.status = response.status_code
+
+    def raise_for_status(self):
+        if self.status is not None and self.status >= 400:
+            raise HTTPException(self.status, f'HTTP {self.status}')
+
+    def write(self, b):
+        n = len(b)
+        checkpoint(n)
+        if self.status is not None and self.status >= 400:
+            return n
+        if self._skip >= n:
+            self._skip -= n
+            return n
+        b = b[self._skip:]
+        self._skip = 0
+        self.file.write(b)
+        self.written += len(b)
+        return n
+
+    def seekable(self):
+        # Retries are handled by download_audio instead of the http layer.
+        return False
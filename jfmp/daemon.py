@@ -0,0 +1,454 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import inspect
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import time
+from queue import Queue
+from threading import Lock, Thread
+from typing import List
+
+from .client import Client
+from .constants import COMMAND_NAME
+from .data import Song, Album, STREAM_THRESHOLD
+from .interfaces import AppInterface
+from .options import add_player_arguments, add_profiling_arguments, \
+    add_sync_arguments, SYNC_WORKERS
+from .player import Player, SAMPLERATE_COMMON
+from .profiling import Profiler, install_toggle
+from .reporting import PlaybackReporter
+from .rpc import SOCKET_LOCATION, RpcError, response, notification, \
+    PARSE_ERROR, INVALID_REQUEST, METHOD_NOT_FOUND, INVALID_PARAMS, \
+    INTERNAL_ERROR
+from .session import SessionStore
+from .scheduler import Scheduler, Limit, INTERACTIVE, SYNC
+from .sync import OfflineSync
+
+LOG = logging.getLogger(__name__)
+
+
+def main(argv=None):
+    """Headless program."""
+    parser = argparse.ArgumentParser(
+        prog=f'{COMMAND_NAME}-daemon',
+        description='Headless jfmp player controlled over a Unix socket.')
+    parser.add_argument(
+        '--socket', default=SOCKET_LOCATION,
+        help=f'path of the control socket (default: {SOCKET_LOCATION})')
+    parser.add_argument(
+        '--exit-with', type=int, metavar='PID',
+        help='exit when the process PID exits')
+    add_player_arguments(parser)
+    add_sync_arguments(parser)
+    add_profiling_arguments(parser)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    daemon = Daemon(args.socket, args.sync_workers, args.sync_bandwidth,
+                    args.samplerate, args.cache, args.stream_threshold,
+                    Profiler(args.profile_interval / 1000,
+                             args.profile_memory))
+    if args.profile:
+        daemon.profiler.start()
+    if args.exit_with is not None:
+        Thread(target=_watch_parent, args=(args.exit_with,),
+               daemon=True).start()
+    daemon.run()
+
+
+def spawn(socket_path: str, *args: str, timeout=60.) -> subprocess.Popen:
+    """Starts a daemon in a separate process and waits until it is ready.
+
+    Extra ``args`` are passed to the daemon's command line. The daemon
+    exits with the current process.
+    """
+    process = subprocess.Popen([
+        sys.executable, '-m', __name__,
+        '--socket', socket_path,
+        '--exit-with', str(os.getpid()),
+        *args,
+    ])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f'the daemon exited with code {process.returncode}')
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            return process
+        except OSError:
+            time.sleep(0.05)
+        finally:
+            probe.close()
+    process.terminate()
+    raise TimeoutError(f'the daemon is not listening on {socket_path}')
+
+
+def _watch_parent(pid: int):
+    while os.getppid() == pid:
+        time.sleep(1)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+class Daemon(AppInterface):
+    """Headless app, controlled through JSON-RPC over a Unix socket.
+
+    Every public ``rpc_*`` method can be called remotely, without the
+    prefix. Calling ``subscribe`` turns the connection into a stream of
+    player event notifications.
+
+    Parameters
+    ----------
+    socket_path : str, optional
+        Path of the control socket, by default the default one.
+    sync_workers : int, optional
+        Maximum number of parallel offline sync downloads.
+    sync_bandwidth : int, optional
+        Offline sync bandwidth cap in bytes per second, by default None for
+        unlimited.
+    samplerate : int or str, optional
+        Output sample rate or policy, see ``Player``.
+    cache : bool, optional
+        Whether the streamed songs are cached, by default True.
+    stream_threshold : int, optional
+        Size in bytes above which songs are streamed in constant memory.
+    profiler : Profiler, optional
+        The profiler toggled by SIGUSR1 and the ``profile`` method, by
+        default one with the default settings.
+    """
+
+    def __init__(self, socket_path=SOCKET_LOCATION,
+                 sync_workers=SYNC_WORKERS, sync_bandwidth=None,
+                 samplerate=SAMPLERATE_COMMON, cache=True,
+                 stream_threshold=STREAM_THRESHOLD,
+                 profiler: Profiler = None):
+        super().__init__()
+        self.cache = cache
+        self.stream_threshold = stream_threshold
+        self.profiler = profiler or Profiler()
+        self.socket_path = socket_path
+        self.player = Player(self, samplerate)
+        self.client = Client(self)
+        self.reporter = PlaybackReporter(self.client, self.player)
+        self.scheduler = Scheduler(
+            {SYNC: Limit(sync_workers, sync_bandwidth)})
+        self.sync = OfflineSync(self.client, self.scheduler)
+        self.session = SessionStore(self.player)
+        self.session.restore()
+        # Serializes the commands sent to the player by the connections.
+        self._lock = Lock()
+        self._subscribers = []
+        self._server = None
+        self.player.add_event_listener('song_change', self._on_song_change)
+        self.player.add_event_listener('queue_change', self._on_queue_change)
+        self.player.add_event_listener(
+            'playing_change', self._on_playing_change)
+        self.player.add_event_listener('track_cost', self._on_track_cost)
+        self.sync.add_event_listener('progress', self._on_sync_progress)
+
+    def run(self):
+        """Serves requests until terminated."""
+        if not self.client.logged_in and not self.client.connect():
+            LOG.warning('not logged in, call "login" to log in')
+        else:
+            self.sync.resume()
+        self._remove_stale_socket()
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.app = self
+        os.chmod(self.socket_path, 0o600)
+        signal.signal(
+            signal.SIGTERM,
+            lambda *args: Thread(target=self._server.shutdown).start())
+        install_toggle(self.profiler)
+        self.reporter.start()
+        self.session.start()
+        LOG.info('listening on %s', self.socket_path)
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+            os.remove(self.socket_path)
+            self.sync.stop()
+            self.scheduler.shutdown()
+            self.session.stop()
+            self.reporter.stop()
+            self.client.stop()
+            self.profiler.stop()
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.remove(self.socket_path)
+        else:
+            raise RuntimeError(f'a daemon is already listening on '
+                               f'{self.socket_path}')
+        finally:
+            probe.close()
+
+    def play_songs(self, songs: List[Song]):
+        with self._lock:
+            self.player.play_new_queue(songs)
+        return songs
+
+    def add_to_queue(self, songs: List[Song]):
+        with self._lock:
+            self.player.add_to_queue(songs)
+
+    def _download_stream(self, song: Song):
+        super()._download_stream(song)
+        # The thin clients read the waveforms from the cache.
+        if os.path.exists(song.url):
+            self._notify('song_cached', song=song.serialize())
+
+    def dispatch(self, method: str, params: dict):
+        """Calls the RPC method with the given params."""
+        func = getattr(self, f'rpc_{method}', None)
+        if func is None:
+            raise RpcError(METHOD_NOT_FOUND, f'unknown method: {method}')
+        try:
+            inspect.signature(func).bind(**params)
+        except TypeError as error:
+            raise RpcError(INVALID_PARAMS, str(error))
+        return func(**params)
+
+    def subscribe(self) -> Queue:
+        """Returns a queue that will receive the event notifications."""
+        queue = Queue()
+        self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: Queue):
+        self._subscribers.remove(queue)
+
+    def _notify(self, method, **params):
+        message = notification(method, **params)
+        for queue in list(self._subscribers):
+            queue.put(message)
+
+    # pylint: disable=unused-argument
+    def _on_song_change(self, oldSong: Song, newSong: Song, **kwargs):
+        self._notify(
+            'song_change',
+            oldSong=oldSong.serialize() if oldSong is not None else None,
+            newSong=newSong.serialize(),
+            index=self.player.curr_song)
+
+    def _on_queue_change(self, songs: List[Song], clear: bool):
+        self._notify('queue_change', songs=[s.serialize() for s in songs],
+                     clear=clear)
+
+    def _on_playing_change(self, playing: bool):
+        self._notify('playing_change', playing=playing)
+
+    def _on_track_cost(self, song: Song, **cost):
+        self._notify('track_cost', song=song.serialize(), **cost)
+
+    def _on_sync_progress(self, **progress):
+        self._notify('sync_progress', **progress)
+
+    def _album(self, album_id: str) -> Album:
+        return Album({'Id': album_id, 'Name': ''})
+
+    def _fetch(self, func, *args):
+        """Runs an api call as interactive work of the scheduler."""
+        return self.scheduler.submit(INTERACTIVE, func, *args).result()
+
+    def rpc_login(self, host: str, username: str, password: str) -> bool:
+        if not self.client.log_in(host, username, password):
+            return False
+        self.sync.resume()
+        return True
+
+    def rpc_status(self) -> dict:
+        song = self.player.core.curSong
+        return {
+            'logged_in': self.client.logged_in,
+            'playing': bool(self.player.core.playing),
+            'position': self.player.get_position(),
+            'duration': self.player.get_duration(),
+            'song': song.serialize() if song is not None else None,
+            'index': self.player.curr_song if self.player.songs else None,
+            'queue_length': len(self.player.songs),
+        }
+
+    def rpc_queue(self) -> List[dict]:
+        return [s.serialize() for s in self.player.songs]
+
+    def rpc_latest_albums(self) -> List[dict]:
+        albums = self._fetch(self.client.get_latest_albums)
+        return [a.serialize() for a in albums]
+
+    def rpc_search(self, term: str) -> List[dict]:
+        albums = self._fetch(self.client.search_albums, term)
+        return [a.serialize() for a in albums]
+
+    def rpc_album_songs(self, album_id: str) -> List[dict]:
+        songs = self._fetch(
+            self.client.get_album_songs, self._album(album_id))
+        return [s.serialize() for s in songs]
+
+    def rpc_play_album(self, album_id: str) -> List[dict]:
+        songs = self._fetch(
+            self.client.get_album_songs, self._album(album_id))
+        self.play_songs(songs)
+        return [s.serialize() for s in songs]
+
+    def rpc_play_songs(self, songs: List[dict]):
+        self.play_songs([Song(s, self) for s in songs])
+
+    def rpc_enqueue(self, album_id: str = None, songs: List[dict] = None):
+        if album_id is not None:
+            added = self._fetch(
+                self.client.get_album_songs, self._album(album_id))
+        else:
+            added = [Song(s, self) for s in songs or []]
+        self.add_to_queue(added)
+        return [s.serialize() for s in added]
+
+    def rpc_play_queue_song(self, index: int):
+        with self._lock:
+            self.player.play_queue_song(index)
+
+    def rpc_play(self):
+        with self._lock:
+            self.player.cmd_play()
+
+    def rpc_pause(self):
+        with self._lock:
+            self.player.cmd_pause()
+
+    def rpc_play_pause(self) -> bool:
+        with self._lock:
+            return self.player.cmd_play_pause()
+
+    def rpc_next(self):
+        with self._lock:
+            self.player.cmd_next()
+
+    def rpc_seek(self, position: float):
+        with self._lock:
+            self.player.cmd_seek(position)
+
+    def rpc_sync_album(self, album_id: str, name: str = ''):
+        self._fetch(self.sync.pin_album, Album({'Id': album_id, 'Name': name}))
+
+    def rpc_sync_artist(self, artist_id: str, name: str = ''):
+        self._fetch(self.sync.pin_artist, artist_id, name)
+
+    def rpc_sync_playlist(self, playlist_id: str, name: str = ''):
+        self._fetch(self.sync.pin_playlist, playlist_id, name)
+
+    def rpc_scheduler_status(self) -> dict:
+        return self.scheduler.stats()
+
+    def rpc_unsync(self, key: str):
+        self.sync.unpin(key)
+
+    def rpc_sync_resume(self):
+        self.sync.resume()
+
+    def rpc_profile(self, enable: bool = None) -> dict:
+        """Starts or stops profiling, toggles it if ``enable`` is not
+        given, and returns the reports written when stopping."""
+        if enable is None:
+            enable = not self.profiler.running
+        if enable:
+            self.profiler.start()
+            reports = []
+        else:
+            reports = self.profiler.stop()
+        return {'running': self.profiler.running, 'reports': reports}
+
+    def rpc_sync_status(self) -> dict:
+        return {
+            'collections': self.sync.collections(),
+            'progress': self.sync.progress(),
+        }
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Handles the requests of one connection."""
+
+    def handle(self):
+        daemon: Daemon = self.server.app
+        for line in self.rfile:
+            request_id = None
+            try:
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    raise RpcError(PARSE_ERROR, str(error))
+                if not isinstance(request, dict) or 'method' not in request:
+                    raise RpcError(INVALID_REQUEST, 'invalid request')
+                request_id = request.get('id')
+                method = request['method']
+                params = request.get('params') or {}
+                if method == 'subscribe':
+                    self._stream(daemon, request_id)
+                    return
+                result = daemon.dispatch(method, params)
+            except RpcError as error:
+                self.wfile.write(response(request_id, error=error))
+            except Exception as error:
+                LOG.exception('error while handling %r', line)
+                self.wfile.write(response(
+                    request_id, error=RpcError(INTERNAL_ERROR, str(error))))
+            else:
+                if request_id is not None:
+                    self.wfile.write(response(request_id, result))
+
+    def _stream(self, daemon: Daemon, request_id):
+        queue = daemon.subscribe()
+
+        def wait_for_close():
+            for _ in self.rfile:
+                pass
+            queue.put(None)
+
+        Thread(target=wait_for_close, daemon=True).start()
+        try:
+            self.wfile.write(response(request_id, daemon.rpc_status()))
+            message = queue.get()
+            while message is not None:
+                self.wfile.write(message)
+                message = queue.get()
+        except OSError:
+            pass
+        finally:
+            daemon.unsubscribe(queue)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,32 +17,25 @@
 
 from os import path
 from io import BufferedIOBase
-from threading import Lock, Condition
+from threading import Condition
 
 from .file import cache_file
+from .scheduler import idle
 
-
-class Semaphore:
-    def __init__(self, init=0):
-        super().__init__()
-        self._cv = Condition(Lock())
-        self._counter = init
-
-    def acquire(self, val=1):
-        with self._cv:
-            self._cv.wait_for(lambda: self._counter >= val)
-            self._counter -= val
-
-    def release(self, val=1):
-        with self._cv:
-            self._counter += val
-            self._cv.notify_all()
+# Songs larger than this are streamed in a ring instead of in memory.
+STREAM_THRESHOLD = 256 * 1024 * 1024
+# Defaults of the streaming-only buffers.
+RING_SIZE = 16 * 1024 * 1024
+RING_SEEK_WINDOW = 4 * 1024 * 1024
 
 
 class DualPositionBytesIO(BufferedIOBase):
     """
     Buffered I/O implementation using an in-memory bytes buffer.
 
+    Reads and seeks past the written data wait for the writer, until it
+    calls ``finish``.
+
     Derived from the original python2 implementation:
     <https://svn.python.org/projects/python/trunk/Lib/_pyio.py>
     """
@@ -55,7 +48,9 @@ class DualPositionBytesIO(BufferedIOBase):
         self._buffer = buf
         self._pos = 0
         self._write_pos = 0
-        self._sem = Semaphore()
+        self._cv = Condition()
+        self._complete = initial_bytes is not None
+        self.error = None
 
     def __getstate__(self):
         return self.__dict__.copy()
@@ -72,11 +67,13 @@ class DualPositionBytesIO(BufferedIOBase):
             raise TypeError("integer argument expected, got {0!r}".format(
                 type(n)))
         if n < 0:
+            self._wait_for_end()
             n = len(self._buffer)
+        else:
+            self._wait_for(self._pos + 1)
         if len(self._buffer) <= self._pos:
             return b""
         newpos = min(len(self._buffer), self._pos + n)
-        self._sem.acquire(newpos - self._pos)
         buff = self._buffer[self._pos: newpos]
         self._pos = newpos
         return bytes(buff)
@@ -95,9 +92,38 @@ class DualPositionBytesIO(BufferedIOBase):
             self._buffer += padding
         self._buffer[pos:pos + n] = b
         self._write_pos += n
-        self._sem.release(n)
+        with self._cv:
+            self._cv.notify_all()
         return n
 
+    def finish(self, error: Exception = None):
+        """Marks the end of the written data, only the first call counts.
+
+        Parameters
+        ----------
+        error : Exception, optional
+            The error that stopped the writer, if any.
+        """
+        with self._cv:
+            if self._complete:
+                return
+            self._complete = True
+            self.error = error
+            self._cv.notify_all()
+
+    def complete(self) -> bool:
+        """Whether all the data has been written."""
+        return self._complete
+
+    def _wait_for(self, size: int):
+        with self._cv:
+            self._cv.wait_for(
+                lambda: len(self._buffer) >= size or self._complete)
+
+    def _wait_for_end(self):
+        with self._cv:
+            self._cv.wait_for(lambda: self._complete)
+
     def seek(self, pos, whence=0):
         try:
             pos.__index__
@@ -110,14 +136,12 @@ class DualPositionBytesIO(BufferedIOBase):
         elif whence == 1:
             newpos = max(0, self._pos + pos)
         elif whence == 2:
+            self._wait_for_end()
             newpos = max(0, len(self._buffer) + pos)
         else:
             raise ValueError("invalid whence value")
-        move = newpos - self._pos
-        if move > 0:
-            self._sem.acquire(move)
-        elif move < 0:
-            self._sem.release(-move)
+        if newpos > self._pos:
+            self._wait_for(newpos)
         self._pos = newpos
         return self._pos
 
@@ -134,11 +158,162 @@ class DualPositionBytesIO(BufferedIOBase):
         return True
 
 
+class RingBytesIO(BufferedIOBase):
+    """
+    Streaming-only buffer, using a fixed-size in-memory ring.
+
+    The writer waits while the ring is full of data that is ahead of the
+    reader, or that is kept behind it for backward seeks, so that a stream
+    of any length takes a constant amount of memory. Reads wait for the
+    writer, until it calls ``finish``. Seeking further back than the data
+    still in the ring is an error, and so is seeking relative to the end
+    before the stream is complete.
+
+    Parameters
+    ----------
+    size : int, optional
+        Capacity of the ring in bytes, by default RING_SIZE.
+    seek_window : int, optional
+        Number of bytes kept behind the read position, by default
+        RING_SEEK_WINDOW.
+    """
+
+    def __init__(self, size=RING_SIZE, seek_window=RING_SEEK_WINDOW):
+        super().__init__()
+        if not 0 <= seek_window < size:
+            raise ValueError("the seek window must be smaller than the ring")
+        self._buffer = bytearray(size)
+        self._size = size
+        self._seek_window = seek_window
+        self._pos = 0
+        self._write_pos = 0
+        self._cv = Condition()
+        self._complete = False
+        self._released = False
+        self.error = None
+
+    def read(self, n=None):
+        if n is None or n < 0:
+            n = self._size
+        if not isinstance(n, int):
+            raise TypeError("integer argument expected, got {0!r}".format(
+                type(n)))
+        with self._cv:
+            self._cv.wait_for(self._readable)
+            self._check_released()
+            n = min(n, self._write_pos - self._pos)
+            if n <= 0:
+                return b""
+            start = self._pos % self._size
+            end = min(start + n, self._size)
+            buff = self._buffer[start:end] + self._buffer[:n - (end - start)]
+            self._pos += n
+            self._cv.notify_all()
+            return bytes(buff)
+
+    def write(self, b):
+        if isinstance(b, str):
+            raise TypeError("can't write unicode to binary stream")
+        view = memoryview(b).cast('B')
+        total = len(view)
+        while view:
+            with self._cv:
+                if self._free() <= 0 and not self._released:
+                    with idle():
+                        self._cv.wait_for(
+                            lambda: self._free() > 0 or self._released)
+                self._check_released()
+                n = min(len(view), self._free())
+                start = self._write_pos % self._size
+                end = min(start + n, self._size)
+                self._buffer[start:end] = view[:end - start]
+                self._buffer[:n - (end - start)] = view[end - start:n]
+                self._write_pos += n
+                self._cv.notify_all()
+            view = view[n:]
+        return total
+
+    def finish(self, error: Exception = None):
+        """Marks the end of the written data, only the first call counts.
+
+        Parameters
+        ----------
+        error : Exception, optional
+            The error that stopped the writer, if any.
+        """
+        with self._cv:
+            if self._complete:
+                return
+            self._complete = True
+            self.error = error
+            self._cv.notify_all()
+
+    def complete(self) -> bool:
+        """Whether all the data has been written."""
+        return self._complete
+
+    def release(self):
+        """Frees the ring, the blocked reads and writes raise ValueError."""
+        with self._cv:
+            self._released = True
+            self._buffer = bytearray()
+            self._cv.notify_all()
+
+    def _readable(self) -> bool:
+        return any((self._write_pos > self._pos, self._complete,
+                    self._released))
+
+    def _free(self) -> int:
+        keep = min(max(0, self._pos - self._seek_window), self._write_pos)
+        return self._size - (self._write_pos - keep)
+
+    def _check_released(self):
+        if self._released:
+            raise ValueError("I/O operation on a released buffer")
+
+    def seek(self, pos, whence=0):
+        try:
+            pos.__index__
+        except AttributeError:
+            raise TypeError("an integer is required")
+        with self._cv:
+            if whence == 0:
+                if pos < 0:
+                    raise ValueError("negative seek position %r" % (pos,))
+                newpos = pos
+            elif whence == 1:
+                newpos = max(0, self._pos + pos)
+            elif whence == 2:
+                if not self._complete:
+                    raise OSError("the end of the stream is not known yet")
+                newpos = max(0, self._write_pos + pos)
+            else:
+                raise ValueError("invalid whence value")
+            if newpos < max(0, self._write_pos - self._size):
+                raise ValueError(
+                    "seek position %r out of the buffered window" % (pos,))
+            self._pos = newpos
+            self._cv.notify_all()
+            return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+
 def ensure_buffered():
     def decorator(func):
         def wrapper(self, *args, **kwargs):
             if self.buff is None:
-                self.buff = DualPositionBytesIO()
+                self.buff = self.app.create_buffer(self)
                 self.app.download_stream(self)
             return func(self, *args, **kwargs)
         return wrapper
@@ -146,6 +321,24 @@ def ensure_buffered():
     return decorator
 
 
+def _audio_samplerate(raw: dict):
+    """Returns the sample rate of the first audio stream of an item, if
+    known."""
+    for stream in raw.get('MediaStreams') or []:
+        if stream.get('Type') == 'Audio' and stream.get('SampleRate'):
+            return stream['SampleRate']
+    return None
+
+
+def _media_size(raw: dict):
+    """Returns the size in bytes of the first media source of an item, if
+    known."""
+    for source in raw.get('MediaSources') or []:
+        if source.get('Size'):
+            return source['Size']
+    return None
+
+
 class Song:
     """Song object.
 
@@ -161,9 +354,12 @@ class Song:
         self.name = raw['Name']
         self.album = raw['Album']
         self.artist = raw['AlbumArtist']
+        self.samplerate = _audio_samplerate(raw)
+        self.size = _media_size(raw)
         self.buff = None
         self.url = cache_file(f'{self.get_id()} - {self.name}')
         self.item = None
+        self.task = None
 
     def __eq__(self, other):
         return self.id == other.id
@@ -172,6 +368,55 @@ class Song:
         """Returns the id."""
         return self.id
 
+    def serialize(self) -> dict:
+        """Returns the raw data needed to recreate this song."""
+        raw = {
+            'Id': self.id,
+            'Name': self.name,
+            'Album': self.album,
+            'AlbumArtist': self.artist,
+        }
+        if self.samplerate is not None:
+            raw['MediaStreams'] = [
+                {'Type': 'Audio', 'SampleRate': self.samplerate}]
+        if self.size is not None:
+            raw['MediaSources'] = [{'Size': self.size}]
+        return raw
+
+    def prefetch(self):
+        """Starts buffering the song in the background."""
+        if self.buff is None:
+            self.buff = self.app.create_buffer(self)
+            self.app.download_stream(self, prefetch=True)
+
+    def streaming_only(self) -> bool:
+        """Whether the song is buffered in a ring, that cannot be replayed."""
+        return isinstance(self.buff, RingBytesIO)
+
+    def release(self):
+        """Stops buffering a song that is not played nor upcoming anymore.
+
+        A song still downloading, or streamed in a ring that cannot be
+        replayed, loses its buffer and is fetched again if it is played
+        later. A song fully buffered in memory is kept.
+        """
+        downloading = self.task is not None and not self.task.done()
+        if not downloading and not self.streaming_only():
+            return
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.streaming_only():
+            self.buff.release()
+        self.buff = None
+
+    def _buffer_in_memory(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.buff.release()
+        self.buff = DualPositionBytesIO()
+        self.app.download_stream(self)
+
     @ensure_buffered()
     def get_input(self):
         """Returns the input of the buffer."""
@@ -188,7 +433,8 @@ class Song:
         if path.exists(self.url) and path.getsize(self.url) > 0:
             with open(self.url, 'rb') as f:
                 self.buff.write(f.read())
-                return True
+            self.buff.finish()
+            return True
         return False
 
     @ensure_buffered()
@@ -207,7 +453,15 @@ class Song:
 
     @ensure_buffered()
     def seekRaw(self, offset, whence):
-        """Seek the buffer."""
+        """Seek the buffer.
+
+        Demuxers seek to the end of files that have their index there, like
+        some m4a. A ring cannot do that before the stream is complete, so
+        the song is buffered in memory instead.
+        """
+        if whence == 2 and self.streaming_only() and \
+                not self.buff.complete():
+            self._buffer_in_memory()
         self.buff.seek(offset, whence)
         # print "seekRaw", self, offset, whence, r, self.rstream.tell()
         return self.buff.tell()
@@ -229,3 +483,10 @@ class Album:
     def get_id(self):
         """Returns the id."""
         return self.id
+
+    def serialize(self) -> dict:
+        """Returns the raw data needed to recreate this album."""
+        return {
+            'Id': self.id,
+            'Name': self.name,
+        }
@@ -0,0 +1,105 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from threading import Lock
+
+from PySide2.QtCore import Qt, QObject, QTimer, Signal, Slot
+
+FRAME_INTERVAL = 16  # ms
+
+
+class EventBus(QObject):
+    """Delivers events to the thread of the bus, usually the GUI one.
+
+    Events can be posted from any thread. They are queued then delivered
+    all at once, at most once per frame. Pending events sharing the same
+    key are coalesced into the last one.
+
+    Parameters
+    ----------
+    interval : int, optional
+        Minimum delay in ms between two deliveries, by default one frame.
+    parent : QObject, optional
+        The parent object, by default None
+    """
+
+    _wake = Signal()
+
+    def __init__(self, interval=FRAME_INTERVAL, parent=None):
+        super().__init__(parent=parent)
+        self._lock = Lock()
+        self._pending = OrderedDict()
+        self._scheduled = False
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._flush)
+        self._wake.connect(self._schedule, Qt.QueuedConnection)
+
+    def post(self, func, key=None, merge=None, coalesce=True, **kwargs):
+        """Schedules a call to ``func(**kwargs)`` on the thread of the bus.
+
+        Parameters
+        ----------
+        func : function
+            The handler to call.
+        key : hashable, optional
+            Pending events with the same key are coalesced, by default the
+            handler itself.
+        merge : function, optional
+            Called with the pending and the new kwargs when coalescing,
+            returns the kwargs to keep. By default the new ones are kept.
+        coalesce : bool, optional
+            Set to False to always deliver this event, by default True.
+        """
+        if not coalesce:
+            key = object()
+        elif key is None:
+            key = func
+        with self._lock:
+            pending = self._pending.pop(key, None)
+            if pending is not None and merge is not None:
+                kwargs = merge(pending[1], kwargs)
+            self._pending[key] = (func, kwargs)
+            scheduled = self._scheduled
+            self._scheduled = True
+        if not scheduled:
+            self._wake.emit()
+
+    def listener(self, func, merge=None, coalesce=True):
+        """Wraps a handler so that it can be called from any thread.
+
+        The returned function can be given to ``Player.add_event_listener``.
+        """
+        def listener(**kwargs):
+            self.post(func, merge=merge, coalesce=coalesce, **kwargs)
+        return listener
+
+    @Slot()
+    def _schedule(self):
+        if not self._timer.isActive():
+            self._timer.start()
+
+    @Slot()
+    def _flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = OrderedDict()
+            self._scheduled = False
+        for func, kwargs in pending.values():
+            func(**kwargs)
@@ -42,3 +42,14 @@ def cache_file(file_name, create=False):
     if create and not os.path.isfile(file_name):
         open(file_name, 'w').close()
     return file_name
+
+
+def runtime_file(file_name):
+    """Returns the path to the requested runtime file, such as a socket."""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir is None:
+        return cache_file(file_name)
+    runtime_dir = os.path.join(runtime_dir, COMMAND_NAME)
+    if not os.path.isdir(runtime_dir):
+        os.makedirs(runtime_dir, mode=0o700)
+    return os.path.join(runtime_dir, file_name)
@@ -17,13 +17,21 @@
 
 from typing import List
 
-from PySide2.QtCore import Qt, Slot, QAbstractListModel, QPoint
+import numpy as np
+from PySide2.QtCore import Qt, Slot, QAbstractListModel, QPoint, QLine, QTimer
 from PySide2.QtGui import *
 from PySide2.QtWidgets import *
 
 from .constants import CLIENT_NAME
 from .data import Song, Album
+from .events import EventBus
 from .interfaces import AppInterface
+from .scheduler import INTERACTIVE
+
+
+def merge_song_changes(pending: dict, new: dict) -> dict:
+    """Keeps the first old song when coalescing song change events."""
+    return dict(new, oldSong=pending['oldSong'])
 
 
 class SearchBar(QLineEdit):
@@ -66,6 +74,12 @@ class QueueQListWidget(QListWidget):
             song.item = item
             self.addItem(item)
 
+    def clear_songs(self):
+        """Removes all the songs."""
+        for i in range(self.count()):
+            self.item(i).data(Qt.UserRole).item = None
+        self.clear()
+
 class AlbumQListWidget(QListWidget):
     def __init__(self,
                  app: AppInterface,
@@ -98,29 +112,114 @@ class AlbumQListWidget(QListWidget):
     def on_doubleclick(self, item: QListWidgetItem):
         """Handler for double click event on album."""
         album = item.data(Qt.UserRole)
+        self.app.scheduler.submit(INTERACTIVE, self._fetch_songs, album,
+                                  self.play_songs)
+
+    def _fetch_songs(self, album: Album, then):
         songs = self.app.client.get_album_songs(album)
-        for i in range(self.queue.count()):
-            self.queue.item(i).data(Qt.UserRole).item = None
-        self.queue.clear()
-        self.queue.add_songs(songs)
+        self.app.main.bus.post(then, coalesce=False, songs=songs)
+
+    def play_songs(self, songs: List[Song]):
         self.tabs.setCurrentWidget(self.queue)
         self.app.play_songs(songs)
 
     def a_add_to_queue(self, album_item: QListWidgetItem):
         album = album_item.data(Qt.UserRole)
-        songs = self.app.client.get_album_songs(album)
-        self.app.add_to_queue(songs)
+        self.app.scheduler.submit(INTERACTIVE, self._fetch_songs, album,
+                                  self.app.add_to_queue)
 
     @Slot()
     def context_menu(self, pos: QPoint):
         item = self.itemAt(pos)
         a_add_to_queue = QAction("Add to Queue", self)
         a_add_to_queue.triggered.connect(lambda: self.a_add_to_queue(item))
+        a_offline = QAction("Make available offline", self)
+        a_offline.triggered.connect(
+            lambda: self.app.make_available_offline(item.data(Qt.UserRole)))
         menu = QMenu(self)
         menu.addAction(a_add_to_queue)
+        menu.addAction(a_offline)
         menu.popup(self.viewport().mapToGlobal(pos))
 
 
+class SeekBar(QWidget):
+    """Playback bar showing the waveform of the current song, click to
+    seek.
+
+    Parameters
+    ----------
+    player : Player
+        The player to show the position of.
+    parent : QtWidget, optional
+        The parent widget, by default None
+    """
+
+    def __init__(self, player, parent=None):
+        super().__init__(parent=parent)
+        self.player = player
+        self.song = None
+        self.peaks = None
+        self.position = 0.
+        self.duration = 0.
+        self.setMinimumHeight(32)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+        self.setCursor(Qt.PointingHandCursor)
+        self._timer = QTimer(self)
+        self._timer.setInterval(250)
+        self._timer.timeout.connect(self.update_position)
+        self._timer.start()
+
+    def set_song(self, song: Song):
+        self.song = song
+        self.peaks = None
+        self.position = 0.
+        self.update()
+
+    def on_waveform(self, song: Song, peaks):
+        """Handler for the waveform of a song being available."""
+        if song is self.song and peaks is not None:
+            self.peaks = peaks
+            self.update()
+
+    @Slot()
+    def update_position(self):
+        if self.song is None:
+            return
+        self.position, self.duration = self.player.get_progress()
+        self.update()
+
+    def mousePressEvent(self, event: QMouseEvent):
+        if event.button() == Qt.LeftButton and self.duration > 0:
+            self.player.cmd_seek(self.duration * event.x() / self.width())
+            self.update_position()
+
+    def paintEvent(self, event: QPaintEvent):
+        width, height = self.width(), self.height()
+        progress = 0
+        if self.duration > 0:
+            progress = int(width * min(1., self.position / self.duration))
+        if self.peaks is None:
+            middle = height // 2
+            played = [QLine(0, middle, progress, middle)]
+            remaining = [QLine(progress, middle, width, middle)]
+        else:
+            # One (min, max) pair per pixel column.
+            columns = np.linspace(
+                0, len(self.peaks), width, endpoint=False).astype(int)
+            peaks = self.peaks[columns].astype(float) / 32768
+            tops = ((1 - peaks[:, 1]) * height / 2).astype(int)
+            bottoms = ((1 - peaks[:, 0]) * height / 2).astype(int)
+            lines = [QLine(x, tops[x], x, bottoms[x]) for x in range(width)]
+            played, remaining = lines[:progress], lines[progress:]
+        painter = QPainter(self)
+        palette = self.palette()
+        painter.setPen(palette.color(QPalette.Highlight))
+        painter.drawLines(played)
+        painter.setPen(palette.color(QPalette.Mid))
+        painter.drawLines(remaining)
+        painter.end()
+
+
 class PlayerWindow(QMainWindow):
     """Main playback window.
 
@@ -135,6 +234,7 @@ class PlayerWindow(QMainWindow):
     def __init__(self, app: AppInterface, parent=None):
         super(PlayerWindow, self).__init__(parent=parent)
         self.app = app
+        self.bus = EventBus(parent=self)
         self.setWindowTitle(CLIENT_NAME)
 
         self.search_bar = SearchBar(app.search)
@@ -168,15 +268,32 @@ class PlayerWindow(QMainWindow):
         self.button_next.setIcon(QIcon.fromTheme('media-skip-forward'))
         self.button_next.setMaximumWidth(30)
         self.button_next.clicked.connect(app.player.cmd_next)
-
-        app.player.add_event_listener('song_change', self.on_song_change)
-        app.player.add_event_listener('playing_change', self.on_playing_change)
+        self.seek_bar = SeekBar(app.player)
+
+        # Player events are emitted from the core's thread.
+        app.player.add_event_listener(
+            'song_change',
+            self.bus.listener(self.on_song_change, merge_song_changes))
+        app.player.add_event_listener(
+            'playing_change',
+            self.bus.listener(self.on_playing_change))
+        app.player.add_event_listener(
+            'queue_change',
+            self.bus.listener(self.on_queue_change, coalesce=False))
+        # Only emitted in thin client mode, once the daemon cached a song.
+        app.player.add_event_listener(
+            'song_cached',
+            self.bus.listener(self.on_song_cached, coalesce=False))
+        # Sync progress is emitted from the download threads.
+        app.sync.add_event_listener(
+            'progress', self.bus.listener(self.on_sync_progress))
 
         controls = QWidget()
         controls_layout = QHBoxLayout()
         layout = QVBoxLayout()
         layout.addWidget(self.search_bar)
         layout.addWidget(self.list_tabs)
+        layout.addWidget(self.seek_bar)
         layout.addWidget(controls)
         controls_layout.addWidget(self.button_play)
         controls_layout.addWidget(self.button_next)
@@ -197,6 +314,11 @@ class PlayerWindow(QMainWindow):
             QKeySequence(Qt.Key_Right),
             content,
             app.player.cmd_next)
+        # Also where there is no SIGUSR1 to toggle the profiler.
+        QShortcut(
+            QKeySequence('Ctrl+Shift+P'),
+            content,
+            self.toggle_profiling)
 
     # pylint: disable=unused-argument
     def on_song_change(self, oldSong: Song, newSong: Song, **kwargs):
@@ -204,9 +326,23 @@ class PlayerWindow(QMainWindow):
         label = f'{newSong.name} - {newSong.album} - {newSong.artist}'
         self.song_label.setText(label)
         self.song_label.setToolTip(label)
+        self.seek_bar.set_song(newSong)
+        self.app.load_waveform(
+            newSong, self.bus.listener(self.seek_bar.on_waveform))
         if oldSong is not None and oldSong.item is not None:
             oldSong.item.setIcon(QIcon())
-        newSong.item.setIcon(QIcon.fromTheme('media-playback-start'))
+        if newSong.item is not None:
+            newSong.item.setIcon(QIcon.fromTheme('media-playback-start'))
+
+    def on_song_cached(self, song: Song):
+        """Handler for song cached event, loads the waveform of the current
+        song if it was not cached yet when the song changed."""
+        current = self.seek_bar.song
+        if current is None or self.seek_bar.peaks is not None or \
+                current.get_id() != song.get_id():
+            return
+        self.app.load_waveform(
+            current, self.bus.listener(self.seek_bar.on_waveform))
 
     def display_albums(self, albums: List[Album]):
         """Displays a list of albums."""
@@ -216,6 +352,12 @@ class PlayerWindow(QMainWindow):
     def add_to_queue(self, songs: List[Song]):
         self.queue_list.add_songs(songs)
 
+    def on_queue_change(self, songs: List[Song], clear: bool):
+        """Handler for queue change event."""
+        if clear:
+            self.queue_list.clear_songs()
+        self.queue_list.add_songs(songs)
+
     def on_playing_change(self, playing: bool):
         """Handler for playing change event."""
         if playing:
@@ -223,6 +365,29 @@ class PlayerWindow(QMainWindow):
         else:
             self.button_play.setIcon(QIcon.fromTheme('media-playback-start'))
 
+    def toggle_profiling(self):
+        """Starts or stops profiling the GUI process."""
+        if self.app.toggle_profiling():
+            self.statusBar().showMessage('Profiling started', 10000)
+        else:
+            self.statusBar().showMessage(
+                'Profiling stopped, see the profiles folder of the cache',
+                10000)
+
+    def on_sync_progress(self, done: int, total: int, failed: int, eta):
+        """Handler for offline sync progress event."""
+        if done + failed == total:
+            message = f'Available offline: {done} songs'
+            if failed:
+                message += f', {failed} failed'
+            self.statusBar().showMessage(message, 10000)
+            return
+        message = f'Making available offline: {done}/{total} songs'
+        if eta is not None:
+            minutes, seconds = divmod(int(eta), 60)
+            message += f', {minutes}:{seconds:02} left'
+        self.statusBar().showMessage(message)
+
 
 class LoginDialog(QDialog):
     """Login dialog.
@@ -274,3 +439,4 @@ class LoginDialog(QDialog):
             LoginDialog(self.app, self.parentWidget()).show()
         else:
             self.app.display_latest_albums()
+            self.app.sync.resume()
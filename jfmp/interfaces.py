@@ -15,12 +15,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 from abc import ABC, abstractmethod
 from typing import List
 
 from .client import Client
-from .data import Song
+from .data import DualPositionBytesIO, RingBytesIO, Song, STREAM_THRESHOLD
 from .player import Player
+from .scheduler import Scheduler, STREAM, INTERACTIVE, PREFETCH, checkpoint
+from .sync import OfflineSync
+from .waveform import get_peaks
+
+CHUNK_SIZE = 64 * 1024
 
 
 class AppInterface(ABC):
@@ -29,6 +35,11 @@ class AppInterface(ABC):
     def __init__(self):
         self.player: Player
         self.client: Client
+        self.scheduler: Scheduler
+        self.sync: OfflineSync
+        # Whether the streamed songs are written to the cache.
+        self.cache = True
+        self.stream_threshold = STREAM_THRESHOLD
 
     @abstractmethod
     def play_songs(self, songs: List[Song]):
@@ -37,3 +48,83 @@ class AppInterface(ABC):
     @abstractmethod
     def add_to_queue(self, songs: List[Song]):
         pass
+
+    def create_buffer(self, song: Song):
+        """Returns a new buffer for a given song.
+
+        Songs larger than ``stream_threshold``, or all of them if the cache
+        is disabled, are streamed in a fixed-size ring, the others are
+        buffered in memory.
+        """
+        if not self.cache or (song.size or 0) > self.stream_threshold:
+            return RingBytesIO()
+        return DualPositionBytesIO()
+
+    def download_stream(self, song: Song, prefetch=False):
+        """Fills the buffer of a given song.
+
+        Cached songs are read at once, the others are downloaded in the
+        background, as the current stream or as a prefetch. Songs streamed
+        in a ring are always filled in the background, as the ring cannot
+        hold them at once.
+        """
+        buff = song.buff
+        if not song.streaming_only() and song.read_from_cache():
+            return
+        song.task = self.scheduler.submit(
+            PREFETCH if prefetch else STREAM, self._download_stream, song)
+        # Ends the buffer on errors and on cancellation.
+        song.task.add_done_callback(lambda task: buff.finish(task.error))
+
+    def load_waveform(self, song: Song, callback):
+        """Calls ``callback(song=song, peaks=peaks)`` from a background
+        task, once the song is cached and its peaks are computed."""
+        def load(*args):
+            self.scheduler.submit(
+                INTERACTIVE, lambda: callback(song=song, peaks=get_peaks(song)))
+        if song.task is not None and not song.task.done():
+            song.task.add_done_callback(load)
+        else:
+            load()
+
+    def _download_stream(self, song: Song):
+        if song.streaming_only():
+            self._stream(song, song.buff)
+            return
+        self.client.get_audio_stream(song)
+        song.buff.finish()
+        if self.cache:
+            song.write_to_cache()
+
+    def _stream(self, song: Song, buff: RingBytesIO):
+        if os.path.exists(song.url) and os.path.getsize(song.url) > 0:
+            with open(song.url, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    checkpoint()
+                    buff.write(chunk)
+        elif not self.cache:
+            self.client.download_audio(song.get_id(), buff)
+        else:
+            # The cache file is written along, and kept once complete.
+            part = f'{song.url}.part'
+            try:
+                with open(part, 'wb') as file:
+                    self.client.download_audio(
+                        song.get_id(), _Tee(file, buff))
+                os.replace(part, song.url)
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+        buff.finish()
+
+
+class _Tee:
+    """Writer copying the data to several writers, in order."""
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def write(self, data) -> int:
+        for writer in self.writers:
+            writer.write(data)
+        return len(data)
@@ -0,0 +1,71 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Command line options shared by the app and the daemon."""
+
+import argparse
+
+from .data import STREAM_THRESHOLD
+from .player import SAMPLERATE_COMMON, parse_samplerate
+from .profiling import profiles_dir
+from .scheduler import DEFAULT_LIMITS, SYNC
+
+SYNC_WORKERS = DEFAULT_LIMITS[SYNC].concurrency
+
+
+def add_player_arguments(parser: argparse.ArgumentParser):
+    """Adds the playback options to a command line parser."""
+    parser.add_argument(
+        '--samplerate', type=parse_samplerate, default=SAMPLERATE_COMMON,
+        metavar='RATE',
+        help="output sample rate in Hz, 'source' to follow each song or "
+             "'common' to use the highest rate of the queue "
+             f'(default: {SAMPLERATE_COMMON})')
+    parser.add_argument(
+        '--no-cache', dest='cache', action='store_false',
+        help='stream every song in constant memory, without caching it')
+    parser.add_argument(
+        '--stream-threshold', type=lambda mib: int(mib) * 1024 * 1024,
+        default=STREAM_THRESHOLD, metavar='MIB',
+        help='stream the songs larger than this in constant memory instead '
+             f'of buffering them (default: {STREAM_THRESHOLD >> 20})')
+
+
+def add_sync_arguments(parser: argparse.ArgumentParser):
+    """Adds the offline sync options to a command line parser."""
+    parser.add_argument(
+        '--sync-workers', type=int, default=SYNC_WORKERS, metavar='N',
+        help='number of parallel offline sync downloads '
+             f'(default: {SYNC_WORKERS})')
+    parser.add_argument(
+        '--sync-bandwidth', type=lambda kib: int(kib) * 1024, metavar='KIB',
+        help='offline sync bandwidth cap in KiB/s (default: unlimited)')
+
+
+def add_profiling_arguments(parser: argparse.ArgumentParser):
+    """Adds the profiling options to a command line parser."""
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='profile from the start, SIGUSR1 toggles profiling at any time '
+             f'and writes the reports to {profiles_dir()}')
+    parser.add_argument(
+        '--profile-interval', type=float, default=10., metavar='MS',
+        help='delay between two CPU samples in milliseconds (default: 10)')
+    parser.add_argument(
+        '--profile-memory', type=float, default=30., metavar='SECONDS',
+        help='delay between two memory snapshots in seconds, 0 to disable '
+             'memory profiling (default: 30)')
@@ -15,13 +15,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import logging
 import pprint
+import threading
+import time
 from collections import defaultdict
-from typing import List
+from typing import List, Tuple, Union
 
 import musicplayer
 
 from .data import Song
+from .scheduler import STREAM
 
 # FFmpeg log levels:
 #   0:panic
@@ -32,41 +36,85 @@ from .data import Song
 #   40:verbose
 musicplayer.setFfmpegLogLevel(20)
 
+# Output sample rate policies.
+SAMPLERATE_SOURCE = 'source'
+SAMPLERATE_COMMON = 'common'
+DEFAULT_SAMPLERATE = 48000
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_samplerate(value: str) -> Union[str, int]:
+    """Parses an output sample rate policy from the command line."""
+    if value in (SAMPLERATE_SOURCE, SAMPLERATE_COMMON):
+        return value
+    return int(value)
+
 
 class Player():
     """Player object.
 
     Parameters
     ----------
-    outSamplerate : int, optional
-        Sample rate used for the output, by default 48000
+    outSamplerate : int or str, optional
+        Sample rate used for the output, by default 48000. It can also be
+        a policy: 'source' to output each song at its own sample rate, or
+        'common' to output the whole queue at the highest sample rate of
+        its songs, so that gapless transitions never change the rate.
+        Songs of unknown sample rate are output at 48000.
     """
 
-    def __init__(self, app, outSamplerate=48000):
+    def __init__(self, app, outSamplerate=DEFAULT_SAMPLERATE):
         self.app = app
         self.core = musicplayer.createPlayer()
-        self.core.outSamplerate = outSamplerate
+        if isinstance(outSamplerate, int):
+            self.samplerate = outSamplerate
+            self.policy = None
+        else:
+            self.samplerate = DEFAULT_SAMPLERATE
+            self.policy = outSamplerate
+        self.core.outSamplerate = self.samplerate
         self.core.queue = self.get_songs()
         self.core.peekQueue = self.peek_songs
         self.core.onSongChange = self._process_onSongChange
         self.songs = []
         self.curr_song = 0
         self.events = defaultdict(list)
+        self._common_samplerate = None
+        self._track_start = None
+        self._resume = None
+        self._peeked = []
 
     def get_songs(self):
         """Generator used to fetch the songs."""
         while True:
-            yield self.songs[self.curr_song]
+            song = self.songs[self.curr_song]
+            if song.task is not None:
+                # The prefetch of the next song is now the current stream.
+                song.task.promote(STREAM)
+            self._apply_samplerate(song)
+            yield song
             self.curr_song += 1
             if self.curr_song >= len(self.songs):
                 self.curr_song = 0
 
     def peek_songs(self, n):
-        """Lookahead the next n songs."""
+        """Lookahead the next n songs, and starts buffering them."""
         next_song = self.curr_song + 1
         if next_song >= len(self.songs):
             next_song = 0
-        return (self.songs[next_song:] + self.songs[:next_song])[:n]
+        songs = (self.songs[next_song:] + self.songs[:next_song])[:n]
+        for song in songs:
+            song.prefetch()
+        # Stops the prefetches that are not upcoming anymore.
+        kept = {id(s) for s in songs}
+        if 0 <= self.curr_song < len(self.songs):
+            kept.add(id(self.songs[self.curr_song]))
+        for song in self._peeked:
+            if id(song) not in kept:
+                song.release()
+        self._peeked = songs
+        return songs
 
     def cmd_play(self):
         """Start playback."""
@@ -92,6 +140,24 @@ class Player():
         """Skip to next song."""
         self.core.nextSong()
 
+    def cmd_seek(self, position: float):
+        """Seek to a position in seconds inside the current song."""
+        if self.core.curSong is not None:
+            self.core.seekAbs(position)
+
+    def get_position(self) -> float:
+        """Get the position in seconds inside the currently played song."""
+        return self.core.curSongPos or 0.
+
+    def get_duration(self) -> float:
+        """Get the duration in seconds of the currently played song."""
+        return self.core.curSongLen or 0.
+
+    def get_progress(self) -> Tuple[float, float]:
+        """Get the position and the duration in seconds of the currently
+        played song."""
+        return self.get_position(), self.get_duration()
+
     def get_metadata(self):
         """Get the matadatas of the currently played song."""
         return pprint.pformat(self.core.curSongMetadata)
@@ -99,6 +165,9 @@ class Player():
     def play_new_queue(self, songs: List[Song]):
         """Replaces the queue with the given one."""
         self.songs = songs
+        self._common_samplerate = None
+        self._update_common_samplerate(songs)
+        self._process_events('queue_change', songs=songs, clear=True)
         self.curr_song = -1
         self.cmd_play()
         self.cmd_next()
@@ -112,6 +181,19 @@ class Player():
     def add_to_queue(self, song: Song):
         """Adds the given song to the queue."""
         self.songs += song
+        self._update_common_samplerate(song)
+        self._process_events('queue_change', songs=song, clear=False)
+
+    def restore_queue(self, songs: List[Song], index: int, position: float):
+        """Restores a saved queue without starting playback.
+
+        Playback will start from the song number 'index' of the queue, at
+        the given position in seconds.
+        """
+        self.songs = songs
+        self.curr_song = index
+        self._update_common_samplerate(songs)
+        self._resume = songs[index], position
 
     def add_event_listener(self, event: str, func):
         """Registers a new handler for a given event."""
@@ -122,5 +204,60 @@ class Player():
             for func in self.events[event]:
                 func(**kwargs)
 
+    def _update_common_samplerate(self, songs: List[Song]):
+        rates = [s.samplerate for s in songs if s.samplerate]
+        if rates:
+            self._common_samplerate = max(
+                rates + [self._common_samplerate or 0])
+
+    def _samplerate_for(self, song: Song) -> int:
+        if self.policy == SAMPLERATE_SOURCE:
+            return song.samplerate or self.samplerate
+        if self.policy == SAMPLERATE_COMMON:
+            return self._common_samplerate or self.samplerate
+        return self.samplerate
+
+    def _apply_samplerate(self, song: Song):
+        """Sets the output sample rate before the core opens the song."""
+        rate = self._samplerate_for(song)
+        if rate != self.core.outSamplerate:
+            LOG.info('output sample rate: %d Hz', rate)
+            self.core.outSamplerate = rate
+
+    def _report_track_cost(self, song: Song):
+        """Logs the CPU time spent while the song was playing by the core's
+        thread, which reads, decodes and resamples the songs.
+
+        Called on song change from the core's thread, the cost is only
+        reported if the previous song change came from the same thread.
+        """
+        wall, cpu = time.monotonic(), time.thread_time()
+        thread = threading.get_ident()
+        if self._track_start is not None and song is not None and \
+                self._track_start[3] == thread:
+            start_wall, start_cpu, rate, _ = self._track_start
+            cost = {
+                'song': song,
+                'samplerate': rate,
+                'cpu_time': cpu - start_cpu,
+                'duration': wall - start_wall,
+            }
+            LOG.info('%s: %.2fs of audio thread CPU for %.1fs at %d Hz',
+                     song.name, cost['cpu_time'], cost['duration'],
+                     cost['samplerate'])
+            self._process_events('track_cost', **cost)
+        self._track_start = wall, cpu, self.core.outSamplerate, thread
+
     def _process_onSongChange(self, **kwargs):
+        if self._resume is not None:
+            song, position = self._resume
+            self._resume = None
+            if kwargs.get('newSong') is song and position:
+                self.core.seekAbs(position)
+        old_song = kwargs.get('oldSong')
+        self._report_track_cost(old_song)
+        if old_song is not None and old_song is not kwargs.get('newSong') \
+                and all(old_song is not s for s in self._peeked):
+            # A skipped song must not keep downloading as the current stream.
+            old_song.release()
         self._process_events('song_change', **kwargs)
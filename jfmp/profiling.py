@@ -0,0 +1,328 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Sampling CPU and memory profiler, to diagnose jfmp on users' machines."""
+
+import importlib
+import importlib.util
+import inspect
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from threading import Event, Lock, Thread
+from typing import List, Optional
+
+from .file import cache_file
+from .scheduler import PRIORITY_NAMES
+
+# Code attributed to each subsystem, as modules, packages or
+# 'module:Class'. An allocation belongs to the subsystem of its innermost
+# matching frame.
+SUBSYSTEMS = (
+    ('buffers', ('jfmp.data:DualPositionBytesIO', 'jfmp.data:RingBytesIO')),
+    ('songs', ('jfmp.data:Song', 'jfmp.data:Album')),
+    ('qt items', ('jfmp.gui', 'PySide2')),
+    ('api responses', ('jfmp.client', 'jellyfin_apiclient_python',
+                       'requests', 'urllib3', 'json')),
+    ('waveforms', ('jfmp.waveform', 'numpy')),
+)
+TRACEMALLOC_FRAMES = 25
+TOP_FUNCTIONS = 20
+TOP_LINES = 10
+
+LOG = logging.getLogger(__name__)
+
+
+def profiles_dir() -> str:
+    """Returns the directory of the profiling reports."""
+    path = cache_file('profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def thread_label(thread: Optional[threading.Thread],
+                 main_label='main') -> str:
+    """Returns the label of a thread in the reports.
+
+    Scheduler threads are labelled by priority class, the other ones by
+    name without their number. Threads unknown to the threading module were
+    started by the audio core, to call back into Python.
+    """
+    if thread is None or isinstance(thread, threading._DummyThread):
+        return 'audio'
+    if thread is threading.main_thread():
+        return main_label
+    match = re.fullmatch(r'Thread-\d+ \((.+)\)', thread.name)
+    if match:
+        return match[1]
+    name = re.sub(r'-[\d_]+$', '', thread.name)
+    if name in PRIORITY_NAMES:
+        return f'worker:{name}'
+    return name
+
+
+class Profiler:
+    """Samples the stacks of every thread and the memory allocations.
+
+    CPU samples are aggregated by thread label and written as folded stacks,
+    the input format of flame graph tools, along with a summary of the
+    hottest functions. Memory snapshots are summarized by subsystem as they
+    are taken, and appended to a report, so that nothing is lost if the
+    app crashes.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Delay in seconds between two CPU samples, by default 0.01.
+    memory_interval : float, optional
+        Delay in seconds between two memory snapshots, by default 30. 0
+        disables the memory profiling.
+    main_label : str, optional
+        Label of the main thread, by default 'main'.
+    """
+
+    def __init__(self, interval=0.01, memory_interval=30., main_label='main'):
+        self.interval = interval
+        self.memory_interval = memory_interval
+        self.main_label = main_label
+        self._lock = Lock()
+        self._stop = Event()
+        self._threads = []
+        self._samples = Counter()
+        self._started = None
+        self._memory_report = None
+        self._last_sizes = {}
+        self._spans = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        """Starts profiling in the background."""
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            self._samples.clear()
+            self._started = time.strftime('%Y%m%d-%H%M%S')
+            self._threads = [Thread(target=self._sample_cpu,
+                                    name='profiler-cpu', daemon=True)]
+            if self.memory_interval:
+                self._memory_report = os.path.join(
+                    profiles_dir(), f'memory-{self._started}.txt')
+                self._last_sizes = {}
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+                self._threads.append(Thread(
+                    target=self._sample_memory, name='profiler-memory',
+                    daemon=True))
+            for thread in self._threads:
+                thread.start()
+        LOG.info('profiling started')
+
+    def stop(self) -> List[str]:
+        """Stops profiling and writes the reports.
+
+        Returns
+        -------
+        List[str]
+            The paths of the reports.
+        """
+        with self._lock:
+            if not self._threads:
+                return []
+            self._stop.set()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        reports = self._write_cpu_reports()
+        if self._memory_report is not None:
+            self.snapshot()
+            tracemalloc.stop()
+            reports.append(self._memory_report)
+            self._memory_report = None
+        LOG.info('profiling stopped, reports: %s', ', '.join(reports))
+        return reports
+
+    def toggle(self) -> List[str]:
+        """Starts or stops profiling, returns the reports if stopped."""
+        if self.running:
+            return self.stop()
+        self.start()
+        return []
+
+    def snapshot(self):
+        """Takes a memory snapshot and appends its summary to the report."""
+        if self._memory_report is None or not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__, all_frames=True),
+        ))
+        sizes = defaultdict(lambda: [0, 0])
+        for stat in snapshot.statistics('traceback'):
+            size = sizes[self._subsystem(stat.traceback)]
+            size[0] += stat.size
+            size[1] += stat.count
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'== {time.strftime("%Y-%m-%d %H:%M:%S")} '
+                 f'traced: {current / 2**20:.1f} MiB, '
+                 f'peak: {peak / 2**20:.1f} MiB',
+                 f'{"subsystem":<24}{"KiB":>12}{"change":>12}{"blocks":>10}']
+        for name, (size, count) in sorted(
+                sizes.items(), key=lambda item: -item[1][0]):
+            change = size - self._last_sizes.get(name, 0)
+            lines.append(f'{name:<24}{size / 1024:>12.0f}'
+                         f'{change / 1024:>+12.0f}{count:>10}')
+        self._last_sizes = {name: size for name, (size, _) in sizes.items()}
+        lines.append('top lines:')
+        for stat in snapshot.statistics('lineno')[:TOP_LINES]:
+            frame = stat.traceback[0]
+            lines.append(f'  {stat.size / 1024:>10.0f} KiB  '
+                         f'{_short_path(frame.filename)}:{frame.lineno}')
+        with open(self._memory_report, 'a') as file:
+            file.write('\n'.join(lines) + '\n\n')
+
+    def _sample_cpu(self):
+        while not self._stop.wait(self.interval):
+            threads = {t.ident: t for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                if thread is not None and thread.name.startswith('profiler'):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ('
+                                 f'{_short_path(code.co_filename)}:'
+                                 f'{code.co_firstlineno})')
+                    frame = frame.f_back
+                label = thread_label(thread, self.main_label)
+                self._samples[(label, *reversed(stack))] += 1
+
+    def _sample_memory(self):
+        while not self._stop.wait(self.memory_interval):
+            try:
+                self.snapshot()
+            except OSError as error:
+                LOG.warning('could not write the memory report: %s', error)
+
+    def _write_cpu_reports(self) -> List[str]:
+        samples = Counter(self._samples)
+        directory = profiles_dir()
+        folded = os.path.join(directory, f'cpu-{self._started}.folded')
+        with open(folded, 'w') as file:
+            for stack, count in samples.most_common():
+                file.write(f'{";".join(stack)} {count}\n')
+        summary = os.path.join(directory, f'cpu-{self._started}.txt')
+        with open(summary, 'w') as file:
+            file.write(_cpu_summary(samples, self.interval))
+        return [folded, summary]
+
+    def _subsystem(self, traceback: tracemalloc.Traceback) -> str:
+        if self._spans is None:
+            self._spans = _subsystem_spans()
+        module = None
+        for frame in reversed(traceback):
+            for name, path, first, last in self._spans:
+                if frame.filename.startswith(path) and \
+                        first <= frame.lineno <= last:
+                    return name
+            if module is None and f'{os.sep}jfmp{os.sep}' in frame.filename:
+                module = 'jfmp.' + os.path.splitext(
+                    os.path.basename(frame.filename))[0]
+        return module or 'other'
+
+
+def _cpu_summary(samples: Counter, interval: float) -> str:
+    by_label = defaultdict(Counter)
+    for stack, count in samples.items():
+        by_label[stack[0]][stack[1:]] += count
+    lines = [f'sampling interval: {interval * 1000:g} ms', '']
+    for label, stacks in sorted(by_label.items(),
+                                key=lambda item: -sum(item[1].values())):
+        total = sum(stacks.values())
+        own, inclusive = Counter(), Counter()
+        for stack, count in stacks.items():
+            if stack:
+                own[stack[-1]] += count
+            for function in set(stack):
+                inclusive[function] += count
+        lines.append(f'== {label}: {total} samples')
+        for title, counter in (('self', own), ('total', inclusive)):
+            lines.append(f'{title}:')
+            for function, count in counter.most_common(TOP_FUNCTIONS):
+                lines.append(f'  {count / total:>7.1%}  {function}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def _subsystem_spans():
+    spans = []
+    for name, targets in SUBSYSTEMS:
+        for target in targets:
+            module_name, _, class_name = target.partition(':')
+            try:
+                if class_name:
+                    module = importlib.import_module(module_name)
+                    obj = getattr(module, class_name)
+                    lines, first = inspect.getsourcelines(obj)
+                    spans.append((name, inspect.getsourcefile(obj), first,
+                                  first + len(lines) - 1))
+                    continue
+                spec = importlib.util.find_spec(module_name)
+            except (ImportError, OSError, TypeError, ValueError):
+                continue
+            if spec is None or not spec.origin:
+                continue
+            path = spec.origin
+            if spec.submodule_search_locations:
+                # Packages span every file of their directory.
+                path = os.path.dirname(path) + os.sep
+            spans.append((name, path, 0, sys.maxsize))
+    return spans
+
+
+def _short_path(filename: str) -> str:
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(path + os.sep):
+            return filename[len(path) + 1:]
+    return filename
+
+
+def install_toggle(profiler: Profiler,
+                   signum=getattr(signal, 'SIGUSR1', None)):
+    """Toggles the profiler when the process receives a signal.
+
+    Nothing is installed if ``signum`` is None, as on Windows, which has no
+    SIGUSR1.
+    """
+    if signum is None:
+        LOG.info('no signal toggles the profiler on this platform')
+        return
+
+    def handler(*args):
+        # Stopping writes the reports, which must not block the main loop.
+        Thread(target=profiler.toggle, name='profiler-toggle').start()
+    signal.signal(signum, handler)
@@ -0,0 +1,237 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Thin client stand-ins for ``Client``, ``Player`` and ``OfflineSync``,
+forwarding every call to a running daemon."""
+
+from collections import defaultdict
+from threading import Thread
+from typing import List, Tuple
+
+from .data import Song, Album
+from .rpc import RpcConnection
+
+
+class RemoteClient:
+    """Forwards the ``Client`` calls to the daemon.
+
+    Parameters
+    ----------
+    app : AppInterface
+        The main app object.
+    connection : RpcConnection
+        The connection to the daemon.
+    """
+
+    def __init__(self, app, connection: RpcConnection):
+        self.app = app
+        self.connection = connection
+
+    @property
+    def logged_in(self) -> bool:
+        return self.connection.call('status')['logged_in']
+
+    def connect(self) -> bool:
+        """Returns whether the daemon is logged in."""
+        return self.logged_in
+
+    def log_in(self, host: str, username: str, password: str) -> bool:
+        """Logs the daemon in."""
+        return self.connection.call(
+            'login', host=host, username=username, password=password)
+
+    def stop(self):
+        self.app.player.stop()
+        self.connection.close()
+
+    def get_latest_albums(self) -> List[Album]:
+        return [Album(a) for a in self.connection.call('latest_albums')]
+
+    def get_album_songs(self, album: Album) -> List[Song]:
+        songs = self.connection.call('album_songs', album_id=album.get_id())
+        return [Song(s, self.app) for s in songs]
+
+    def search_albums(self, text) -> List[Album]:
+        return [Album(a) for a in self.connection.call('search', term=text)]
+
+
+class RemotePlayer:
+    """Forwards the ``Player`` commands to the daemon and relays its
+    events.
+
+    Events are emitted from a dedicated thread, like the local player's
+    are emitted from the core's thread.
+
+    Parameters
+    ----------
+    app : AppInterface
+        The main app object.
+    connection : RpcConnection
+        The connection to the daemon.
+    """
+
+    def __init__(self, app, connection: RpcConnection):
+        self.app = app
+        self.connection = connection
+        self.songs = [Song(s, app) for s in connection.call('queue')]
+        self.curr_song = 0
+        self.events = defaultdict(list)
+        self._current = None
+        self._events = RpcConnection(connection.path)
+        self._thread = Thread(
+            target=self._listen, name='remote-player', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._events.close()
+
+    def cmd_play(self):
+        self.connection.call('play')
+
+    def cmd_pause(self):
+        self.connection.call('pause')
+
+    # pylint: disable=unused-argument
+    def cmd_play_pause(self, *args):
+        return self.connection.call('play_pause')
+
+    # pylint: disable=unused-argument
+    def cmd_next(self, *args):
+        self.connection.call('next')
+
+    def cmd_seek(self, position: float):
+        self.connection.call('seek', position=position)
+
+    def get_position(self) -> float:
+        return self.connection.call('status')['position']
+
+    def get_duration(self) -> float:
+        return self.connection.call('status')['duration']
+
+    def get_progress(self) -> Tuple[float, float]:
+        status = self.connection.call('status')
+        return status['position'], status['duration']
+
+    # The queue is updated by the queue change events of the daemon, which
+    # also reflect the changes made by its other clients.
+    def play_new_queue(self, songs: List[Song]):
+        self.connection.call(
+            'play_songs', songs=[s.serialize() for s in songs])
+
+    def play_queue_song(self, i: int):
+        self.connection.call('play_queue_song', index=i)
+
+    def add_to_queue(self, songs: List[Song]):
+        self.connection.call('enqueue', songs=[s.serialize() for s in songs])
+
+    def add_event_listener(self, event: str, func):
+        """Registers a new handler for a given event."""
+        self.events[event].append(func)
+
+    def _process_events(self, event: str, **kwargs):
+        if self.events.get(event):
+            for func in self.events[event]:
+                func(**kwargs)
+
+    def _resolve(self, raw: dict, index=None) -> Song:
+        """Finds the local song matching the one sent by the daemon."""
+        if index is not None and 0 <= index < len(self.songs) and \
+                self.songs[index].get_id() == raw['Id']:
+            return self.songs[index]
+        if self._current is not None and self._current.get_id() == raw['Id']:
+            return self._current
+        for song in self.songs:
+            if song.get_id() == raw['Id']:
+                return song
+        return Song(raw, self.app)
+
+    def _listen(self):
+        try:
+            self._events.call('subscribe')
+            for message in self._events.notifications():
+                params = message['params']
+                if message['method'] == 'song_change':
+                    old_song = params['oldSong']
+                    if old_song is not None:
+                        old_song = self._resolve(old_song)
+                    self.curr_song = params['index']
+                    self._current = self._resolve(
+                        params['newSong'], params['index'])
+                    self._process_events(
+                        'song_change', oldSong=old_song, newSong=self._current)
+                elif message['method'] == 'queue_change':
+                    songs = [Song(s, self.app) for s in params['songs']]
+                    if params['clear']:
+                        self.songs = songs
+                    else:
+                        self.songs = self.songs + songs
+                    self._process_events(
+                        'queue_change', songs=songs, clear=params['clear'])
+                elif message['method'] == 'song_cached':
+                    self._process_events(
+                        'song_cached', song=self._resolve(params['song']))
+                else:
+                    self._process_events(message['method'], **params)
+        except (OSError, ValueError):
+            # The connection was closed.
+            pass
+
+
+class RemoteSync:
+    """Forwards the ``OfflineSync`` calls to the daemon, which downloads
+    the songs into its own cache.
+
+    Parameters
+    ----------
+    connection : RpcConnection
+        The connection to the daemon.
+    player : RemotePlayer
+        The player relaying the daemon's events.
+    """
+
+    def __init__(self, connection: RpcConnection, player: RemotePlayer):
+        self.connection = connection
+        self.player = player
+
+    def pin_album(self, album: Album):
+        self.connection.call('sync_album', album_id=album.get_id())
+
+    def pin_artist(self, artist_id: str, name: str):
+        self.connection.call('sync_artist', artist_id=artist_id, name=name)
+
+    def pin_playlist(self, playlist_id: str, name: str):
+        self.connection.call(
+            'sync_playlist', playlist_id=playlist_id, name=name)
+
+    def unpin(self, key: str):
+        self.connection.call('unsync', key=key)
+
+    def collections(self) -> dict:
+        return self.connection.call('sync_status')['collections']
+
+    def progress(self) -> dict:
+        return self.connection.call('sync_status')['progress']
+
+    def resume(self):
+        self.connection.call('sync_resume')
+
+    def stop(self):
+        """The daemon keeps syncing."""
+
+    def add_event_listener(self, event: str, func):
+        """Registers a new handler for a given event."""
+        self.player.add_event_listener(f'sync_{event}', func)
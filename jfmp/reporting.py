@@ -0,0 +1,228 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import time
+from threading import Condition, Thread
+
+from .file import conf_file
+
+REPORTS_LOCATION = conf_file('reports.json')
+TICKS_PER_SECOND = 10 ** 7
+
+LOG = logging.getLogger(__name__)
+
+
+class PlaybackReporter:
+    """Reports playback start, progress and stop to the server.
+
+    Player events only queue the reports, which are sent in batches from a
+    background thread, so the audio callback thread never waits for the
+    network. Progress is reported at most once every ``interval`` seconds.
+    Reports that could not be sent are persisted to disk and sent again
+    once the server is reachable.
+
+    Parameters
+    ----------
+    client : Client
+        The client used to send the reports.
+    player : Player
+        The player to report the state of.
+    interval : float, optional
+        Delay in seconds between two progress reports, by default 10.
+    retry_delay : float, optional
+        Maximum delay in seconds between two attempts to send pending
+        reports while offline, by default 60.
+    """
+
+    def __init__(self, client, player, interval=10., retry_delay=60.):
+        self.client = client
+        self.player = player
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self._cv = Condition()
+        self._pending = self._load()
+        self._song = None
+        # Last sampled (position, duration, time) of the current song.
+        self._sample = None
+        self._paused = True
+        self._next_progress = 0.
+        self._sending = 0
+        self._running = False
+        self._thread = None
+        player.add_event_listener('song_change', self.on_song_change)
+        player.add_event_listener('playing_change', self.on_playing_change)
+
+    def start(self):
+        """Starts sending reports in the background."""
+        with self._cv:
+            if self._running:
+                return
+            self._running = True
+        self._thread = Thread(target=self._run, name='reporter', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.):
+        """Reports the current song as stopped, then stops sending reports.
+
+        Reports that could not be sent within ``timeout`` seconds are saved
+        for the next session.
+        """
+        with self._cv:
+            if self._song is not None:
+                self._queue('stop', self._song)
+                self._song = None
+                self._sample = None
+            self._running = False
+            self._cv.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._cv:
+            pending = list(self._pending)
+        self._save(pending)
+
+    # pylint: disable=unused-argument
+    def on_song_change(self, oldSong, newSong, **kwargs):
+        """Handler for song change event."""
+        with self._cv:
+            if oldSong is not None:
+                # The player already reports the position in the new song.
+                self._queue('stop', oldSong, position=self._played())
+            self._song = newSong
+            self._sample = 0., 0., time.monotonic()
+            self._queue('start', newSong, position=0)
+            self._next_progress = time.monotonic() + self.interval
+            self._cv.notify()
+
+    def on_playing_change(self, playing: bool):
+        """Handler for playing change event."""
+        with self._cv:
+            self._paused = not playing
+            if self._song is not None:
+                self._queue('progress', self._song)
+                self._next_progress = time.monotonic() + self.interval
+                self._cv.notify()
+
+    def _played(self) -> float:
+        """Estimates the position reached in the current song from its
+        last sample."""
+        if self._sample is None:
+            return 0.
+        position, duration, sampled = self._sample
+        if not self._paused:
+            position += time.monotonic() - sampled
+        if duration:
+            position = min(position, duration)
+        return position
+
+    def _queue(self, event, song, position=None):
+        if position is None:
+            position = self.player.get_position()
+            if song is self._song:
+                self._sample = (position, self.player.get_duration(),
+                                time.monotonic())
+        report = {
+            'ItemId': song.get_id(),
+            'PositionTicks': int(position * TICKS_PER_SECOND),
+            'IsPaused': self._paused,
+            'CanSeek': True,
+        }
+        if event == 'progress' and len(self._pending) > self._sending:
+            last_event, last_report = self._pending[-1]
+            if last_event == 'progress' and \
+                    last_report['ItemId'] == report['ItemId']:
+                # Only the latest progress of a song is worth sending.
+                self._pending[-1] = (event, report)
+                return
+        self._pending.append((event, report))
+
+    def _queue_progress(self):
+        if self._song is None or self._paused or \
+                time.monotonic() < self._next_progress:
+            return
+        self._queue('progress', self._song)
+        self._next_progress = time.monotonic() + self.interval
+
+    def _run(self):
+        delay = 1.
+        saved = os.path.exists(REPORTS_LOCATION)
+        while True:
+            with self._cv:
+                if self._running and not self._pending:
+                    self._cv.wait(self._timeout())
+                self._queue_progress()
+                if not self._pending:
+                    if not self._running:
+                        return
+                    continue
+                batch = list(self._pending)
+                self._sending = len(batch)
+            sent = self._send(batch)
+            with self._cv:
+                del self._pending[:sent]
+                self._sending = 0
+                pending = list(self._pending)
+                running = self._running
+            if sent < len(batch):
+                self._save(pending)
+                saved = True
+                if not running:
+                    return
+                with self._cv:
+                    self._cv.wait_for(lambda: not self._running, delay)
+                delay = min(delay * 2, self.retry_delay)
+            elif saved:
+                # Back online, the offline queue has been flushed.
+                self._save(pending)
+                saved = bool(pending)
+                delay = 1.
+
+    def _timeout(self):
+        if self._song is None or self._paused:
+            return None
+        return max(0., self._next_progress - time.monotonic())
+
+    def _send(self, batch) -> int:
+        """Sends the reports in order, returns how many were sent."""
+        if not self.client.logged_in:
+            return 0
+        for i, (event, report) in enumerate(batch):
+            try:
+                self.client.report_playback(event, report)
+            except Exception as error:
+                LOG.info('could not report playback %s: %s', event, error)
+                return i
+        return len(batch)
+
+    def _load(self):
+        if os.path.exists(REPORTS_LOCATION):
+            try:
+                with open(REPORTS_LOCATION) as file:
+                    return [tuple(r) for r in json.load(file)]
+            except ValueError:
+                LOG.warning('ignoring invalid %s', REPORTS_LOCATION)
+        return []
+
+    def _save(self, pending):
+        if pending:
+            with open(REPORTS_LOCATION, 'w') as file:
+                json.dump(pending, file)
+        elif os.path.exists(REPORTS_LOCATION):
+            os.remove(REPORTS_LOCATION)
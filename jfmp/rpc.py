@@ -0,0 +1,112 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""JSON-RPC 2.0 over a local Unix socket, one message per line."""
+
+import json
+import socket
+from threading import Lock
+
+from .file import runtime_file
+
+SOCKET_LOCATION = runtime_file('daemon.sock')
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RpcError(Exception):
+    """Error returned by a remote procedure call."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def encode(message: dict) -> bytes:
+    """Encodes a message as a line of JSON."""
+    return json.dumps(message).encode() + b'\n'
+
+
+def response(request_id, result=None, error: RpcError = None) -> bytes:
+    """Encodes the response to a request."""
+    message = {'jsonrpc': '2.0', 'id': request_id}
+    if error is not None:
+        message['error'] = {'code': error.code, 'message': str(error)}
+    else:
+        message['result'] = result
+    return encode(message)
+
+
+def notification(method: str, **params) -> bytes:
+    """Encodes a notification, a message that expects no response."""
+    return encode({'jsonrpc': '2.0', 'method': method, 'params': params})
+
+
+class RpcConnection:
+    """Client side of a connection to the daemon.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to the socket of the daemon, by default the default one.
+    """
+
+    def __init__(self, path=SOCKET_LOCATION):
+        self.path = path
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._file = self._socket.makefile('rwb')
+        self._lock = Lock()
+        self._id = 0
+
+    def call(self, method: str, **params):
+        """Calls a method of the daemon and returns its result."""
+        with self._lock:
+            self._id += 1
+            self._file.write(encode({
+                'jsonrpc': '2.0',
+                'id': self._id,
+                'method': method,
+                'params': params,
+            }))
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError('the daemon closed the connection')
+        message = json.loads(line)
+        if 'error' in message:
+            error = message['error']
+            raise RpcError(error['code'], error['message'])
+        return message.get('result')
+
+    def notifications(self):
+        """Yields the notifications sent by the daemon, once subscribed."""
+        for line in self._file:
+            yield json.loads(line)
+
+    def close(self):
+        """Closes the connection."""
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._file.close()
+        self._socket.close()
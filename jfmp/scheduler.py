@@ -0,0 +1,361 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Central scheduler of the background network work."""
+
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+from threading import Condition, Lock, Thread, local
+from typing import Dict, NamedTuple, Optional
+
+# Priority classes, from the most to the least urgent.
+STREAM = 0
+INTERACTIVE = 1
+PREFETCH = 2
+SYNC = 3
+PRIORITIES = (STREAM, INTERACTIVE, PREFETCH, SYNC)
+PRIORITY_NAMES = ('stream', 'interactive', 'prefetch', 'sync')
+
+LOG = logging.getLogger(__name__)
+
+_current = local()
+
+
+class Limit(NamedTuple):
+    """Limits of a priority class.
+
+    Parameters
+    ----------
+    concurrency : int
+        Maximum number of tasks of the class running at once.
+    bandwidth : int, optional
+        Maximum total throughput of the class in bytes per second, by
+        default None for unlimited.
+    """
+    concurrency: int
+    bandwidth: Optional[int] = None
+
+
+DEFAULT_LIMITS = {
+    STREAM: Limit(2),
+    INTERACTIVE: Limit(4),
+    PREFETCH: Limit(2),
+    SYNC: Limit(4),
+}
+
+
+class Cancelled(Exception):
+    """Raised inside a task that was cancelled, and by its result."""
+
+
+class RateLimiter:
+    """Token bucket limiting the throughput shared by several threads.
+
+    Parameters
+    ----------
+    rate : int, optional
+        Maximum throughput in bytes per second, by default None for
+        unlimited.
+    burst : float, optional
+        Number of seconds of throughput that can be consumed at once,
+        by default 1.
+    """
+
+    def __init__(self, rate=None, burst=1.):
+        self.rate = rate
+        self.burst = burst
+        self._lock = Lock()
+        self._tokens = 0.
+        self._last = time.monotonic()
+
+    def consume(self, n: int):
+        """Blocks until ``n`` bytes can be transferred."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.rate * self.burst,
+                self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def current_task() -> Optional['Task']:
+    """Returns the task running in the current thread, if any."""
+    return getattr(_current, 'task', None)
+
+
+def checkpoint(nbytes=0):
+    """Lets the scheduler pause or cancel the current task.
+
+    Long running tasks should call it regularly, with the number of bytes
+    they transferred since the last call. Outside of a task, it does
+    nothing.
+    """
+    task = current_task()
+    if task is not None:
+        task.checkpoint(nbytes)
+
+
+@contextmanager
+def idle():
+    """Marks the current task as waiting for its consumer.
+
+    An idle task does not preempt the less urgent ones, so that a stream
+    throttled by playback lets the other classes run meanwhile.
+    """
+    task = current_task()
+    if task is None:
+        yield
+        return
+    task.scheduler._set_idle(task, True)
+    try:
+        yield
+    finally:
+        task.scheduler._set_idle(task, False)
+
+
+class Task:
+    """Handle on a function submitted to the scheduler."""
+
+    def __init__(self, scheduler: 'Scheduler', priority: int, func, args,
+                 kwargs):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._done = False
+        self._cancelled = False
+        self._idle = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def error(self) -> Optional[Exception]:
+        """The error that stopped the task, if any."""
+        return self._error
+
+    def done(self) -> bool:
+        return self._done
+
+    def cancel(self):
+        """Cancels the task.
+
+        A pending task never runs, a running one is stopped at its next
+        checkpoint.
+        """
+        self.scheduler._cancel(self)
+
+    def add_done_callback(self, func):
+        """Calls ``func(task)`` once the task is done, even if it never
+        ran."""
+        with self.scheduler._cv:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def promote(self, priority: int):
+        """Moves the task to a more urgent priority class."""
+        self.scheduler._promote(self, priority)
+
+    def result(self, timeout=None):
+        """Waits for the task to finish and returns its result."""
+        with self.scheduler._cv:
+            if not self.scheduler._cv.wait_for(self.done, timeout):
+                raise TimeoutError
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def checkpoint(self, nbytes=0):
+        """Waits while more urgent tasks are running and for the bandwidth
+        of the class, raises Cancelled if the task was cancelled."""
+        self.scheduler._checkpoint(self, nbytes)
+
+    def _run(self):
+        _current.task = self
+        try:
+            if self._cancelled:
+                raise Cancelled
+            result = self.func(*self.args, **self.kwargs)
+        except Exception as error:
+            if not isinstance(error, Cancelled):
+                LOG.exception('error in %s task %s',
+                              PRIORITY_NAMES[self.priority], self.func)
+            self.scheduler._finish(self, error=error)
+        else:
+            self.scheduler._finish(self, result)
+        finally:
+            _current.task = None
+
+
+class Scheduler:
+    """Runs the background work by priority class.
+
+    Each class has its own concurrency and bandwidth limits. Pending tasks
+    start in priority order, as soon as their class has a free slot. A
+    running task is preempted at its checkpoints while tasks of a more
+    urgent class are running: a bulk sync pauses while the current track
+    is streamed.
+
+    Parameters
+    ----------
+    limits : Dict[int, Limit], optional
+        Limits by priority class, missing classes use the default ones.
+    """
+
+    def __init__(self, limits: Dict[int, Limit] = None):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._limiters = {p: RateLimiter(self.limits[p].bandwidth)
+                          for p in PRIORITIES}
+        self._cv = Condition()
+        self._pending = {p: deque() for p in PRIORITIES}
+        self._running = {p: 0 for p in PRIORITIES}
+        self._idle = {p: 0 for p in PRIORITIES}
+        self._active = set()
+        self._ids = count()
+        self._closed = False
+
+    def submit(self, priority: int, func, *args, **kwargs) -> Task:
+        """Schedules a function call in a priority class."""
+        task = Task(self, priority, func, args, kwargs)
+        with self._cv:
+            if self._closed:
+                task._cancelled = task._done = True
+                task._error = Cancelled()
+                return task
+            self._pending[priority].append(task)
+            self._dispatch()
+        return task
+
+    def stats(self) -> dict:
+        """Returns the number of pending and running tasks by class."""
+        with self._cv:
+            return {PRIORITY_NAMES[p]: {
+                'pending': len(self._pending[p]),
+                'running': self._running[p],
+                'idle': self._idle[p],
+            } for p in PRIORITIES}
+
+    def shutdown(self):
+        """Cancels every pending and running task."""
+        with self._cv:
+            self._closed = True
+            tasks = [t for p in PRIORITIES for t in self._pending[p]]
+            tasks += self._active
+        for task in tasks:
+            task.cancel()
+        with self._cv:
+            self._cv.notify_all()
+
+    def _dispatch(self):
+        for priority in PRIORITIES:
+            pending = self._pending[priority]
+            while pending and \
+                    self._running[priority] < self.limits[priority].concurrency:
+                task = pending.popleft()
+                self._running[priority] += 1
+                self._active.add(task)
+                Thread(target=task._run, daemon=True,
+                       name=f'{PRIORITY_NAMES[priority]}-{next(self._ids)}'
+                       ).start()
+
+    def _preempted(self, task: Task) -> bool:
+        return task.priority > STREAM and any(
+            self._running[p] - self._idle[p] for p in range(task.priority))
+
+    def _checkpoint(self, task: Task, nbytes: int):
+        with self._cv:
+            self._cv.wait_for(
+                lambda: task._cancelled or not self._preempted(task))
+            if task._cancelled:
+                raise Cancelled
+            priority = task.priority
+        self._limiters[priority].consume(nbytes)
+
+    def _cancel(self, task: Task):
+        with self._cv:
+            if task._done:
+                return
+            task._cancelled = True
+            pending = self._pending[task.priority]
+            if task not in pending:
+                self._cv.notify_all()
+                return
+            pending.remove(task)
+            task._done = True
+            task._error = Cancelled()
+            self._cv.notify_all()
+        self._call_back(task)
+
+    def _promote(self, task: Task, priority: int):
+        with self._cv:
+            if task._done or priority >= task.priority:
+                return
+            pending = self._pending[task.priority]
+            if task in pending:
+                pending.remove(task)
+                self._pending[priority].appendleft(task)
+            else:
+                self._running[task.priority] -= 1
+                self._running[priority] += 1
+                if task._idle:
+                    self._idle[task.priority] -= 1
+                    self._idle[priority] += 1
+            task.priority = priority
+            self._dispatch()
+            self._cv.notify_all()
+
+    def _set_idle(self, task: Task, idle: bool):
+        with self._cv:
+            if task._idle != idle:
+                task._idle = idle
+                self._idle[task.priority] += 1 if idle else -1
+                self._cv.notify_all()
+
+    def _finish(self, task: Task, result=None, error=None):
+        with self._cv:
+            self._running[task.priority] -= 1
+            self._active.discard(task)
+            task._result = result
+            task._error = error
+            task._done = True
+            if not self._closed:
+                self._dispatch()
+            self._cv.notify_all()
+        self._call_back(task)
+
+    def _call_back(self, task: Task):
+        for func in task._callbacks:
+            try:
+                func(task)
+            except Exception:
+                LOG.exception('error in the callback of %s', task.func)
@@ -0,0 +1,160 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+from threading import Event, Lock, Thread
+from typing import List
+
+from .data import Song
+from .file import conf_file
+
+QUEUE_LOCATION = conf_file('queue.jsonl')
+POSITION_LOCATION = conf_file('position.json')
+
+LOG = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """Saves the queue and the playback position of a player, so that the
+    next session resumes where this one stopped.
+
+    The queue is saved as one line of JSON per song: adding songs only
+    appends lines, only replacing the queue rewrites the file. The position
+    is saved on song change, on pause and every ``interval`` seconds while
+    playing. Restoring needs no request to the server: the songs are
+    recreated from the saved metadata and read from the audio cache.
+
+    Parameters
+    ----------
+    player : Player
+        The player to save the state of.
+    interval : float, optional
+        Delay in seconds between two saves of the position while playing,
+        by default 5.
+    """
+
+    def __init__(self, player, interval=5.):
+        self.player = player
+        self.interval = interval
+        self._lock = Lock()
+        self._stop = Event()
+        self._playing = False
+        self._thread = None
+        # The restored song, index and position, until a song is played.
+        self._restored = None
+        player.add_event_listener('queue_change', self.on_queue_change)
+        player.add_event_listener('song_change', self.on_song_change)
+        player.add_event_listener('playing_change', self.on_playing_change)
+
+    def restore(self) -> bool:
+        """Restores the saved queue and position into the player.
+
+        Returns
+        -------
+        bool
+            False if there was nothing to restore.
+        """
+        try:
+            songs = self._load_queue()
+            position = self._load_position()
+        except (OSError, ValueError, KeyError) as error:
+            LOG.warning('could not restore the previous session: %s', error)
+            return False
+        if not songs:
+            return False
+        index = position.get('index', 0)
+        if not 0 <= index < len(songs):
+            index = 0
+        position = position.get('position', 0.)
+        self.player.restore_queue(songs, index, position)
+        self._restored = songs[index], index, position
+        return True
+
+    def start(self):
+        """Starts saving the position periodically."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name='session', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Saves the position and stops saving it periodically."""
+        self._stop.set()
+        self._thread = None
+        self.save_position()
+
+    def save_position(self, position=None):
+        if not self.player.songs:
+            return
+        index = self.player.curr_song
+        if self._restored is not None:
+            # Nothing played since the restore, its position is kept.
+            _, index, position = self._restored
+        elif position is None:
+            position = self.player.get_position()
+        data = {'index': index, 'position': position}
+        with self._lock:
+            with open(f'{POSITION_LOCATION}.tmp', 'w') as file:
+                json.dump(data, file)
+            os.replace(f'{POSITION_LOCATION}.tmp', POSITION_LOCATION)
+
+    def on_queue_change(self, songs: List[Song], clear: bool):
+        """Handler for queue change event."""
+        if clear:
+            self._restored = None
+        with self._lock:
+            with open(QUEUE_LOCATION, 'w' if clear else 'a') as file:
+                for song in songs:
+                    file.write(json.dumps(song.serialize()) + '\n')
+
+    # pylint: disable=unused-argument
+    def on_song_change(self, newSong: Song, **kwargs):
+        """Handler for song change event."""
+        restored, self._restored = self._restored, None
+        if restored is not None and newSong is restored[0]:
+            # The player seeks to the restored position, which the core may
+            # not report yet.
+            self.save_position(restored[2])
+        else:
+            self.save_position(0.)
+
+    def on_playing_change(self, playing: bool):
+        """Handler for playing change event."""
+        self._playing = playing
+        if not playing:
+            self.save_position()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._playing:
+                self.save_position()
+
+    def _load_queue(self) -> List[Song]:
+        if not os.path.exists(QUEUE_LOCATION):
+            return []
+        with open(QUEUE_LOCATION) as file:
+            return [Song(json.loads(line), self.player.app)
+                    for line in file if line.strip()]
+
+    def _load_position(self) -> dict:
+        if not os.path.exists(POSITION_LOCATION):
+            return {}
+        with open(POSITION_LOCATION) as file:
+            return json.load(file)
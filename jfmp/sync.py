@@ -0,0 +1,201 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from threading import Lock
+from typing import List
+
+from .data import Song, Album
+from .file import conf_file
+from .scheduler import Scheduler, Cancelled, SYNC
+
+SYNC_LOCATION = conf_file('sync.json')
+
+LOG = logging.getLogger(__name__)
+
+
+class OfflineSync:
+    """Makes collections of songs available offline.
+
+    The songs of a pinned collection are downloaded into the audio cache
+    by the scheduler's sync class, whose concurrency and bandwidth are
+    limited, and which pauses while more urgent work is running. Pinned
+    collections are saved, so an interrupted sync resumes on the next
+    start, skipping the songs that are already cached. Cache eviction must
+    leave the songs for which ``is_pinned`` is True.
+
+    Progress is reported through the 'progress' event, with the number of
+    songs done and to do, the failures and the estimated remaining time.
+
+    Parameters
+    ----------
+    client : Client
+        The client used to download the songs.
+    scheduler : Scheduler
+        The scheduler running the downloads.
+    """
+
+    def __init__(self, client, scheduler: Scheduler):
+        self.client = client
+        self.scheduler = scheduler
+        self.events = defaultdict(list)
+        self._lock = Lock()
+        self._collections = self._load()
+        self._tasks = {}
+        self._done = 0
+        self._total = 0
+        self._failed = 0
+        self._bytes = 0
+        self._start = None
+
+    def pin_album(self, album: Album):
+        """Makes an album available offline."""
+        songs = self.client.get_album_songs(album)
+        self.pin(f'album:{album.get_id()}', album.name, songs)
+
+    def pin_artist(self, artist_id: str, name: str):
+        """Makes all the songs of an artist available offline."""
+        songs = self.client.get_artist_songs(artist_id)
+        self.pin(f'artist:{artist_id}', name, songs)
+
+    def pin_playlist(self, playlist_id: str, name: str):
+        """Makes a playlist available offline."""
+        songs = self.client.get_playlist_songs(playlist_id)
+        self.pin(f'playlist:{playlist_id}', name, songs)
+
+    def pin(self, key: str, name: str, songs: List[Song]):
+        """Pins a collection of songs and downloads the missing ones."""
+        with self._lock:
+            self._collections[key] = {
+                'name': name,
+                'songs': [s.serialize() for s in songs],
+            }
+            self._save()
+        self._download_all(songs)
+
+    def unpin(self, key: str):
+        """Unpins a collection, its songs stay in the cache."""
+        with self._lock:
+            self._collections.pop(key, None)
+            self._save()
+
+    def collections(self) -> dict:
+        """Returns the names of the pinned collections by key."""
+        with self._lock:
+            return {k: c['name'] for k, c in self._collections.items()}
+
+    def is_pinned(self, song_id: str) -> bool:
+        """Whether the song belongs to a pinned collection."""
+        with self._lock:
+            return any(s['Id'] == song_id
+                       for c in self._collections.values()
+                       for s in c['songs'])
+
+    def resume(self):
+        """Downloads the missing songs of every pinned collection."""
+        with self._lock:
+            raws = [s for c in self._collections.values() for s in c['songs']]
+        self._download_all([Song(raw, None) for raw in raws])
+
+    def stop(self):
+        """Cancels the pending downloads."""
+        with self._lock:
+            tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+
+    def progress(self) -> dict:
+        """Returns the progress of the current sync."""
+        with self._lock:
+            eta = None
+            remaining = self._total - self._done - self._failed
+            if self._done and self._bytes:
+                elapsed = time.monotonic() - self._start
+                song_size = self._bytes / self._done
+                eta = remaining * song_size / (self._bytes / elapsed)
+            return {
+                'done': self._done,
+                'total': self._total,
+                'failed': self._failed,
+                'eta': eta if remaining else 0.,
+            }
+
+    def add_event_listener(self, event: str, func):
+        """Registers a new handler for a given event."""
+        self.events[event].append(func)
+
+    def _process_events(self, event: str, **kwargs):
+        if self.events.get(event):
+            for func in self.events[event]:
+                func(**kwargs)
+
+    def _download_all(self, songs: List[Song]):
+        with self._lock:
+            if self._done + self._failed == self._total:
+                # Previous sync is over, start a new one.
+                self._done = self._total = self._failed = self._bytes = 0
+                self._start = time.monotonic()
+            for song in songs:
+                if not self._is_queued_or_cached(song):
+                    self._total += 1
+                    self._tasks[song.get_id()] = self.scheduler.submit(
+                        SYNC, self._download, song)
+        self._process_events('progress', **self.progress())
+
+    def _is_queued_or_cached(self, song: Song) -> bool:
+        return song.get_id() in self._tasks or os.path.exists(song.url)
+
+    def _download(self, song: Song):
+        part = f'{song.url}.part'
+        try:
+            with open(part, 'wb') as file:
+                self.client.download_audio(song.get_id(), file)
+            if not os.path.getsize(part):
+                raise OSError('empty response')
+            os.replace(part, song.url)
+        except Cancelled:
+            os.remove(part)
+            with self._lock:
+                self._tasks.pop(song.get_id(), None)
+            raise
+        except Exception as error:
+            LOG.warning('could not download %s: %s', song.name, error)
+            if os.path.exists(part):
+                os.remove(part)
+            with self._lock:
+                self._failed += 1
+        else:
+            with self._lock:
+                self._done += 1
+                self._bytes += os.path.getsize(song.url)
+        with self._lock:
+            self._tasks.pop(song.get_id(), None)
+        self._process_events('progress', **self.progress())
+
+    def _load(self) -> dict:
+        if os.path.exists(SYNC_LOCATION):
+            with open(SYNC_LOCATION) as file:
+                return json.load(file)
+        return {}
+
+    def _save(self):
+        with open(SYNC_LOCATION, 'w') as file:
+            json.dump(self._collections, file)
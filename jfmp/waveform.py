@@ -0,0 +1,122 @@
+# Copyright (C) 2020  Nicolas Peugnet
+#
+# This file is part of jfmp.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Waveform overview of the cached songs."""
+
+import logging
+import os
+import subprocess
+from typing import Optional
+
+import numpy as np
+
+from .data import Song
+from .scheduler import checkpoint
+
+PEAKS_BINS = 2000
+# Samples reduced at once while decoding, a few thousand blocks still fit
+# in a bin for songs longer than a minute.
+BLOCK_SIZE = 1024
+READ_SIZE = BLOCK_SIZE * 2 * 256
+
+LOG = logging.getLogger(__name__)
+
+
+def peaks_file(song: Song) -> str:
+    """Returns the path of the peaks stored next to the cached song."""
+    return f'{song.url}.peaks'
+
+
+def get_peaks(song: Song) -> Optional[np.ndarray]:
+    """Returns the peaks of a song, computing them if needed.
+
+    Returns
+    -------
+    np.ndarray, optional
+        The (min, max) pairs of each bin, as int16, or None if the song is
+        not cached or could not be decoded.
+    """
+    path = peaks_file(song)
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            return np.load(file)
+    if not os.path.exists(song.url):
+        return None
+    peaks = compute_peaks(song.url)
+    if peaks is not None:
+        with open(f'{path}.tmp', 'wb') as file:
+            np.save(file, peaks)
+        os.replace(f'{path}.tmp', path)
+    return peaks
+
+
+def compute_peaks(path: str, bins=PEAKS_BINS) -> Optional[np.ndarray]:
+    """Decodes an audio file and reduces it to the (min, max) pairs of
+    ``bins`` bins.
+
+    The file is decoded to mono 16-bit samples by ffmpeg, and reduced block
+    by block while it is decoded, so that long files never need to fit in
+    memory.
+    """
+    try:
+        process = subprocess.Popen(
+            ['ffmpeg', '-v', 'error', '-i', path,
+             '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    except OSError as error:
+        LOG.warning('could not run ffmpeg: %s', error)
+        return None
+    try:
+        mins, maxs = _reduce_blocks(process.stdout)
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+    if not len(mins):
+        return None
+    return _reduce_bins(mins, maxs, bins)
+
+
+def _reduce_blocks(stream):
+    mins, maxs = [], []
+    rest = b''
+    while True:
+        checkpoint()
+        data = stream.read(READ_SIZE)
+        if not data:
+            break
+        data = rest + data
+        end = len(data) - len(data) % (BLOCK_SIZE * 2)
+        rest = data[end:]
+        if end:
+            blocks = np.frombuffer(data[:end], '<i2').reshape(-1, BLOCK_SIZE)
+            mins.append(blocks.min(axis=1))
+            maxs.append(blocks.max(axis=1))
+    if len(rest) >= 2:
+        tail = np.frombuffer(rest[:len(rest) - len(rest) % 2], '<i2')
+        mins.append(tail.min(keepdims=True))
+        maxs.append(tail.max(keepdims=True))
+    if not mins:
+        return np.empty(0, '<i2'), np.empty(0, '<i2')
+    return np.concatenate(mins), np.concatenate(maxs)
+
+
+def _reduce_bins(mins: np.ndarray, maxs: np.ndarray, bins: int):
+    bins = min(bins, len(mins))
+    starts = np.linspace(0, len(mins), bins, endpoint=False).astype(int)
+    return np.stack([np.minimum.reduceat(mins, starts),
+                     np.maximum.reduceat(maxs, starts)], axis=1)